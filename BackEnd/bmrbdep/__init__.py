@@ -3,17 +3,22 @@
 import datetime
 import functools
 import logging
+import mimetypes
 import os
 import socket
 import tempfile
+import time
 import traceback
-from typing import Dict, Union, Any, Optional, List
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Union, Any, Optional, List, Tuple
 from uuid import uuid4
 
 import pynmrstar
 import requests
 import simplejson as json
 import werkzeug.exceptions
+import werkzeug.http
 from dns.exception import Timeout
 from dns.resolver import NXDOMAIN
 from flask import Flask, request, jsonify, url_for, redirect, send_file, send_from_directory, Response
@@ -21,12 +26,16 @@ from flask_mail import Mail, Message
 from validate_email import validate_email
 
 from bmrbdep import depositions
-from bmrbdep.common import configuration, get_schema, root_dir, secure_filename, get_release
+from bmrbdep.common import configuration, get_schema, get_pynmrstar_schema, get_serialized_schema, root_dir, \
+    secure_filename, secure_full_path, get_release
 from bmrbdep.database import init_db
 from bmrbdep.depositions import DepositionRepo
 from bmrbdep.exceptions import ServerError, RequestError
 from bmrbdep.helpers import tokens
+from bmrbdep.helpers.archives import stream_zip, stream_tar
+from bmrbdep.helpers.entry_operations import apply_operations
 from bmrbdep.helpers.star_tools import assign_unique_ids, merge_entries
+from bmrbdep.helpers.upload_sessions import UploadSession
 
 application = Flask(__name__)
 
@@ -219,11 +228,45 @@ def send_local_file(filename: str = None) -> Response:
     return send_from_directory(directory=angular_path, path=filename)
 
 
+def _get_schema_hash(schema_version: str) -> str:
+    """ Returns the hash of the schema of a deposition, which is also the ETag it is served with by send_schema. """
+
+    try:
+        return get_serialized_schema(schema_version)[0]
+    except RequestError:
+        raise ServerError("Entry specifies schema that doesn't exist on the server: %s" % schema_version)
+
+
+@application.route('/deposition/schema/<version>')
+def send_schema(version: str) -> Response:
+    """ Returns the JSON schema for a schema version.
+
+    The response is pre-serialized and pre-compressed once per version. The newest schema version is rewritten in
+    place when the schema is reloaded, so browsers must revalidate their copy (by its ETag, the hash of the schema)
+    every time they use it. """
+
+    etag, serialized, compressed = get_serialized_schema(secure_filename(version))
+
+    if request.accept_encodings['gzip']:
+        response = Response(compressed, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag + '-gzip')
+    else:
+        response = Response(serialized, mimetype='application/json')
+        response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, no-cache'
+
+    # Answers If-None-Match with a 304 (the response is modified in place)
+    response.make_conditional(request)
+    return response
+
+
 @application.route('/deposition/<uuid:uuid>/check-valid')
 def send_validation_status(uuid) -> Response:
     """ Returns whether or not an entry has been validated. """
 
-    with depositions.DepositionRepo(str(uuid)) as repo:
+    with depositions.DepositionRepo(str(uuid), read_only=True) as repo:
         return jsonify({'status': repo.metadata['email_validated'],
                         'commit': repo.last_commit})
 
@@ -335,7 +378,7 @@ def duplicate_deposition(uuid) -> Response:
     schema_name = configuration['schema_version']
     if request_info.get('deposition_type', 'macromolecule') == "small molecule":
         schema_name += "-sm"
-    schema: pynmrstar.Schema = pynmrstar.Schema(get_schema(schema_name, schema_format='xml'))
+    schema: pynmrstar.Schema = get_pynmrstar_schema(schema_name)
     json_schema: dict = get_schema(schema_name)
     entry_template: pynmrstar.Entry = pynmrstar.Entry.from_template(entry_id=deposition_id, all_tags=True,
                                                                     default_values=True, schema=schema)
@@ -440,7 +483,7 @@ def new_deposition() -> Response:
     schema_name = configuration['schema_version']
     if request_info.get('deposition_type', 'macromolecule') == "small molecule":
         schema_name += "-sm"
-    schema: pynmrstar.Schema = pynmrstar.Schema(get_schema(schema_name, schema_format='xml'))
+    schema: pynmrstar.Schema = get_pynmrstar_schema(schema_name)
     json_schema: dict = get_schema(schema_name)
     entry_template: pynmrstar.Entry = pynmrstar.Entry.from_template(entry_id=deposition_id, all_tags=True,
                                                                     default_values=True, schema=schema)
@@ -663,9 +706,17 @@ def deposit_entry(uuid) -> Response:
     if 'deposition_contents' not in request.form or not request.form['deposition_contents']:
         raise RequestError('No deposition submitted.')
     final_entry: pynmrstar.Entry = pynmrstar.Entry.from_string(request.form['deposition_contents'])
+    # Reject what deposit() would reject anyway before spending time on the lookups
+    with depositions.DepositionRepo(uuid, read_only=True) as repo:
+        if repo.metadata['entry_deposited']:
+            raise RequestError('Entry already deposited, no changes allowed.')
+        if not repo.metadata['email_validated']:
+            raise RequestError('You must validate your e-mail before deposition.')
+    # These can take a while, so don't hold the lock on the deposition while they run
+    lookups = depositions.prefetch_deposit_lookups(final_entry)
 
     with depositions.DepositionRepo(uuid) as repo:
-        bmrb_num = repo.deposit(final_entry)
+        bmrb_num = repo.deposit(final_entry, lookups=lookups)
 
         # Send out the e-mails
         contact_emails: List[str] = final_entry.get_loops_by_category("_Contact_Person")[0].get_tag(['Email_address'])
@@ -713,7 +764,24 @@ def file_operations(uuid, path: str) -> Response:
     # Werkzeug implicitly allows HEAD wherever GET is allowed, and dispatches it to this view
     if request.method in ("GET", "HEAD"):
         with depositions.DepositionRepo(uuid, read_only=True) as repo:
-            return send_file(path_or_file=repo.get_file(path, root=False), download_name=path)
+            file_path: str = repo.get_file_path(path, root=False)
+            offload: Optional[str] = configuration.get('file_download_offload')
+            if offload not in ('x-accel-redirect', 'x-sendfile'):
+                # Given a path (rather than a file object), send_file supports Range and conditional requests, and
+                #  uwsgi sends the file with sendfile() - from an offload thread, if offload-threads is set
+                return send_file(path_or_file=file_path, download_name=path, conditional=True)
+
+            # Have the web server send the file instead, so that large files don't occupy a worker
+            relative_path: str = os.path.relpath(file_path, configuration['repo_path'])
+            response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            response.headers.set('Content-Disposition', 'inline', filename=path)
+            if offload == 'x-accel-redirect':
+                prefix: str = configuration.get('file_download_offload_prefix', '/internal-depositions/')
+                response.headers['X-Accel-Redirect'] = urllib.parse.quote(prefix.rstrip('/') + '/' + relative_path)
+            else:
+                prefix = configuration.get('file_download_offload_prefix', configuration['repo_path'])
+                response.headers['X-Sendfile'] = os.path.join(prefix, relative_path)
+            return response
     elif request.method == "DELETE":
         with depositions.DepositionRepo(uuid) as repo:
             if repo.delete_data_file(path):
@@ -723,9 +791,48 @@ def file_operations(uuid, path: str) -> Response:
         raise ServerError('If you see this, then somebody changed the allowed methods without changing the logic.')
 
 
+@application.route('/deposition/<uuid:uuid>/archive', methods=('GET',))
+def download_archive(uuid) -> Response:
+    """ Download all the data files of a deposition at once, as a zip (the default) or tar archive. The archive is
+    generated while it is sent.
+
+    Query parameters: format=zip|tar, entry=true to include the entry (entry.str, and deposition.str if it was
+    deposited), compress=false to store the files in the zip archive without compressing them (files that are
+    already compressed are never compressed again). """
+
+    archive_format: str = request.args.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        raise RequestError("The archive format must be 'zip' or 'tar'.")
+
+    # Only find the files with the lock held, and read them while the archive is sent - files are only ever
+    #  replaced by renaming, so each file is consistent, but a file removed in the meantime is left out
+    with depositions.DepositionRepo(uuid, read_only=True) as repo:
+        files: List[Tuple[str, str]] = [('%s/data_files/%s' % (uuid, name), repo.get_file_path(name, root=False))
+                                        for name in sorted(repo.get_data_file_list())]
+        if request.args.get('entry', 'false').lower() == 'true':
+            for name in ('entry.str', 'deposition.str'):
+                try:
+                    files.append(('%s/%s' % (uuid, name), repo.get_file_path(name)))
+                except RequestError:
+                    pass
+
+    if archive_format == 'zip':
+        response = Response(stream_zip(files, compress=request.args.get('compress', 'true').lower() != 'false'),
+                            mimetype='application/zip')
+    else:
+        response = Response(stream_tar(files), mimetype='application/x-tar')
+    response.headers.set('Content-Disposition', 'attachment', filename='%s.%s' % (uuid, archive_format))
+    return response
+
+
 @application.route('/deposition/<uuid:uuid>/file', methods=('POST',))
 def store_file(uuid) -> Response:
-    """ Stores a data file based on uuid. """
+    """ Stores one or more uploaded data files based on uuid.
+
+    Response: {"filenames": [<names the files were stored under>], "files": [{"filename": <uploaded name>,
+    "stored_as": <name>} or {"filename": <uploaded name>, "error": <why it wasn't stored>}, ...], "changed": bool,
+    "commit": <commit>, "lock_seconds": <how long the deposition was locked>}
+    """
 
     # Build the repo object (this validates that the UUID exists) but do NOT take
     # the lock yet: we want to receive the upload - the slow, network-bound part -
@@ -750,23 +857,165 @@ def store_file(uuid) -> Response:
         if not uploaded:
             raise RequestError('No file uploaded, or file uploaded with the wrong parameter name!')
 
-        # Capture (staged path, destination name) before taking the lock. Closing
+        # Capture (destination name, staged path) before taking the lock. Closing
         # the FileStorage flushes and closes the file without deleting it.
-        staged: List[tuple] = []
+        staged: List[Tuple[str, str]] = []
         for file_ in uploaded:
             source_path = file_.stream.name
             file_.close()
-            staged.append((source_path, file_.filename))
+            # Nothing has been stored yet, and the staging directory is removed along with the staged files
+            if not file_.filename:
+                raise RequestError('Every uploaded file must have a file name.')
+            staged.append((file_.filename, source_path))
+
+        # Set the final permissions and write the git objects (so the commit doesn't
+        # have to read the files again) for all the files in parallel, before taking
+        # the lock. Hashing and compressing release the GIL.
+        def prepare_file(staged_file: Tuple[str, str]) -> Union[bytes, OSError]:
+            try:
+                os.chmod(staged_file[1], 0o644)
+                return repo.store_blob(staged_file[1])
+            except OSError as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=configuration.get('file_threads', 8)) as executor:
+            blobs: List[Union[bytes, OSError]] = list(executor.map(prepare_file, staged))
+
+        statuses: List[Dict[str, str]] = [{'filename': filename} for filename, _ in staged]
+        prepared: List[Tuple[int, Tuple[str, str, bytes]]] = []
+        for position, ((filename, source_path), blob) in enumerate(zip(staged, blobs)):
+            if isinstance(blob, OSError):
+                statuses[position]['error'] = 'Could not store the file: %s' % (blob.strerror or type(blob).__name__)
+            else:
+                prepared.append((position, (filename, source_path, blob)))
+
+        # Now take the lock only to move the staged files into place and commit. A
+        # folder of thousands of files is stored in batches, each with its own commit,
+        # so the lock is never held for long.
+        batch_size: int = configuration.get('upload_batch_size', 1000)
+        changed: bool = False
+        commit: Optional[str] = None
+        lock_seconds: float = 0
+        for batch_start in range(0, len(prepared), batch_size):
+            batch = prepared[batch_start:batch_start + batch_size]
+            with depositions.DepositionRepo(uuid) as batch_repo:
+                locked_at: float = time.monotonic()
+                results = batch_repo.move_data_files([file_ for _, file_ in batch])
+                changed = batch_repo.commit("User uploaded %d file(s)." %
+                                            sum(not isinstance(_, OSError) for _ in results)) or changed
+                commit = batch_repo.last_commit
+                lock_seconds += time.monotonic() - locked_at
+            for (position, _), result in zip(batch, results):
+                if isinstance(result, OSError):
+                    statuses[position]['error'] = 'Could not store the file: %s' % \
+                                                  (result.strerror or type(result).__name__)
+                else:
+                    statuses[position]['stored_as'] = result
+
+        if lock_seconds > configuration.get('slow_lock_seconds', 5):
+            logging.warning('Storing %d uploaded file(s) held the lock on deposition %s for %.1f seconds.',
+                            len(staged), uuid, lock_seconds)
+
+        filenames: List[str] = [_['stored_as'] for _ in statuses if 'stored_as' in _]
+        if not filenames:
+            raise RequestError('None of the uploaded files could be stored. %s' % statuses[0]['error'])
+        return jsonify({'filenames': filenames, 'files': statuses, 'changed': changed, 'commit': commit,
+                        'lock_seconds': round(lock_seconds, 3)})
+
+
+@application.route('/deposition/<uuid:uuid>/upload', methods=('POST',))
+def start_chunked_upload(uuid) -> Response:
+    """ Start a resumable upload of a data file, for files too large to send in a single request. The file
+    is then sent in chunks, which are staged until the upload is finished (see chunked_upload), so a dropped
+    connection only costs the chunks that didn't make it.
+
+    Body: {"filename": <path of the file in the deposition>, "size": <size of the file in bytes>}
+
+    Response: {"upload_id": <ID of the upload>}
+    """
+
+    payload = request.get_json()
+    if not isinstance(payload, dict) or 'filename' not in payload or 'size' not in payload:
+        raise RequestError("Must specify the 'filename' and 'size' of the file to upload.")
+    filename, size = payload['filename'], payload['size']
+    if not isinstance(filename, str) or not filename:
+        raise RequestError("The 'filename' must be the (non-empty) path of the file in the deposition.")
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise RequestError("The 'size' must be the size of the file in bytes.")
+    # Fail now rather than once the whole file was uploaded
+    secure_full_path(filename)
+
+    with depositions.DepositionRepo(uuid, read_only=True) as repo:
+        if repo.metadata['entry_deposited']:
+            raise RequestError('Entry already deposited, no changes allowed.')
+
+    UploadSession.remove_expired(_UPLOAD_STAGING_ROOT, configuration.get('upload_session_hours', 48) * 3600)
+    session = UploadSession.create(_UPLOAD_STAGING_ROOT, str(uuid), filename, size,
+                                   max_size=configuration.get('max_upload_bytes', 100 * 1024 ** 3))
+    return jsonify({'upload_id': session.upload_id})
+
+
+@application.route('/deposition/<uuid:uuid>/upload/<uuid:upload_id>', methods=('GET', 'PUT', 'DELETE'))
+def chunked_upload(uuid, upload_id) -> Response:
+    """ Send a chunk of a resumable upload (PUT), get which parts of the file were received (GET) or abandon
+    the upload (DELETE).
+
+    A chunk is sent as the raw request body, with the bytes it contains given by a Content-Range header
+    ("bytes <first byte>-<last byte>/<file size>"), and optionally its SHA-256 digest (hex) in an
+    X-Chunk-SHA256 header. Chunks may be sent in any order and in parallel, and sending a chunk again is harmless.
+
+    Response (GET and PUT): {"size": <file size>, "received": [[<first byte>, <last byte>], ...], "complete": bool}
+    """
+
+    session = UploadSession(_UPLOAD_STAGING_ROOT, str(uuid), str(upload_id))
+
+    if request.method == 'DELETE':
+        session.discard()
+        return jsonify({'upload_id': session.upload_id})
+
+    if request.method == 'PUT':
+        with depositions.DepositionRepo(uuid, read_only=True) as repo:
+            if repo.metadata['entry_deposited']:
+                raise RequestError('Entry already deposited, no changes allowed.')
+
+        content_range = werkzeug.http.parse_content_range_header(request.headers.get('Content-Range'))
+        if not content_range or content_range.start is None or content_range.stop is None or \
+                content_range.length != session.size:
+            raise RequestError('Chunks must be sent with a Content-Range header of the form bytes '
+                               '<first byte>-<last byte>/%d.' % session.size)
+        session.write_chunk(content_range.start, content_range.stop - 1, request.stream,
+                            sha256=request.headers.get('X-Chunk-SHA256'))
 
-        # Now take the lock only to move the staged files into place and commit -
-        # a fast, atomic rename per file rather than the whole upload duration.
+    return jsonify({'size': session.size, 'received': session.received_ranges(), 'complete': session.complete})
+
+
+@application.route('/deposition/<uuid:uuid>/upload/<uuid:upload_id>/finish', methods=('POST',))
+def finish_chunked_upload(uuid, upload_id) -> Response:
+    """ Store the file of a completely received resumable upload in the deposition. The response is the
+    same as for a regular upload. """
+
+    session = UploadSession(_UPLOAD_STAGING_ROOT, str(uuid), str(upload_id))
+    if not session.complete:
+        raise RequestError('The upload is not complete yet. Only these bytes were received: %s' %
+                           (', '.join('%d-%d' % _ for _ in session.received_ranges()) or 'none'))
+
+    session.claim()
+    try:
+        # As for regular uploads, the file is hashed before taking the lock
+        repo = depositions.DepositionRepo(uuid)
+        blob: bytes = repo.store_blob(session.data_path)
         with repo:
-            filenames: List[str] = []
-            for source_path, destination in staged:
-                filenames.append(repo.write_file(destination, source_path=source_path, move=True))
+            # The entry may have been deposited since the upload was started
+            repo.raise_write_errors()
+            filename: str = repo.write_file(session.filename, source_path=session.data_path, move=True, blob=blob)
+            changed: bool = repo.commit("User uploaded 1 file(s).")
+            commit: str = repo.last_commit
+    except BaseException:
+        session.release()
+        raise
+    session.discard()
 
-            changed: bool = repo.commit("User uploaded %d file(s)." % len(filenames))
-            return jsonify({'filenames': filenames, 'changed': changed, 'commit': repo.last_commit})
+    return jsonify({'filenames': [filename], 'changed': changed, 'commit': commit})
 
 
 @application.route('/deposition/<uuid:uuid>', methods=('GET', 'PUT'))
@@ -782,14 +1031,16 @@ def fetch_or_store_deposition(uuid):
             raise RequestError("Invalid JSON uploaded. The JSON was not a valid NMR-STAR entry.")
 
         with depositions.DepositionRepo(uuid) as repo:
-            existing_entry: pynmrstar.Entry = repo.entry
+            existing_entry: pynmrstar.Entry = repo.entry_read_only
 
-            # If they aren't making any changes
+            # If they aren't making any changes. Comparing digests of the rendered saveframes is much cheaper than
+            #  comparing the entries, and tells us what changed.
             try:
-                if existing_entry == entry:
-                    return jsonify({'commit': repo.last_commit})
+                changed_saveframes: List[str] = repo.changed_saveframes(entry)
             except ValueError as err:
                 raise RequestError(repr(err))
+            if existing_entry.entry_id == entry.entry_id and not changed_saveframes:
+                return jsonify({'commit': repo.last_commit, 'changed_saveframes': []})
 
             if existing_entry.entry_id != entry.entry_id:
                 raise RequestError("Refusing to overwrite entry with entry of different ID.")
@@ -801,45 +1052,56 @@ def fetch_or_store_deposition(uuid):
 
             # Update the entry data
             repo.entry = entry
-            repo.commit("Entry updated.")
+            repo.commit("Entry updated.", defer=True)
 
-            return jsonify({'commit': repo.last_commit})
+            return jsonify({'commit': repo.last_commit, 'changed_saveframes': changed_saveframes})
 
     # Load an entry
     else:
 
-        with depositions.DepositionRepo(uuid) as repo:
-            entry: pynmrstar.Entry = repo.entry
+        # The revision (normally the commit hash) and the hash of the schema are the ETag. If the client already has
+        #  the current revision, answer after only looking at HEAD - without going through git or loading the entry.
+        if request.if_none_match:
+            with depositions.DepositionRepo(uuid, read_only=True) as repo:
+                revision: Optional[str] = repo.current_revision
+                etag: Optional[str] = '%s.%s' % (revision, _get_schema_hash(repo.metadata['schema_version'])) \
+                    if revision else None
+            if etag and request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+
+        # Loading only needs a shared lock, so viewers of the same deposition don't wait on each other. Legacy
+        #  depositions without saveframe _Unique_IDs are migrated ahead of time by bmrbdep.backfill_unique_ids.
+        with depositions.DepositionRepo(uuid, read_only=True) as repo:
             schema_version: str = repo.metadata['schema_version']
             data_files: List[str] = repo.get_data_file_list()
             email_validated: bool = repo.metadata['email_validated']
             entry_deposited: bool = repo.metadata['entry_deposited']
             deposition_nickname: str = repo.metadata['deposition_nickname']
             bmrbnum: Optional[int] = repo.metadata.get('bmrbnum')
-
-            # Lazy backfill: pre-existing depositions created before incremental save
-            # have no `_Unique_ID` tags. Assign them on first GET so subsequent
-            # per-saveframe PUTs can match by ID. Deposited entries are sealed.
-            if not entry_deposited and assign_unique_ids(entry, overwrite=False) > 0:
-                repo.entry = entry
-                repo.commit("Backfilled per-saveframe unique IDs.")
-
+            entry_json: bytes = repo.entry_json
             commit: str = repo.last_commit
-        try:
-            schema: dict = get_schema(schema_version)
-        except RequestError:
-            raise ServerError("Entry specifies schema that doesn't exist on the server: %s" % schema_version)
-
-        entry: dict = entry.get_json(serialize=False)
-        entry['schema'] = schema
-        entry['data_files'] = data_files
-        entry['email_validated'] = email_validated
-        entry['entry_deposited'] = entry_deposited
-        entry['deposition_nickname'] = deposition_nickname
-        entry['bmrbnum'] = bmrbnum
-        entry['commit'] = [commit]
-
-        return jsonify(entry)
+        # The schema itself is served separately (see send_schema), so the client can cache it across entries. Its
+        #  hash tells the client whether the copy it has is still current.
+        schema_hash: str = _get_schema_hash(schema_version)
+
+        deposition_info: bytes = json.dumps({'schema_version': schema_version,
+                                             'schema_hash': schema_hash,
+                                             'data_files': data_files,
+                                             'email_validated': email_validated,
+                                             'entry_deposited': entry_deposited,
+                                             'deposition_nickname': deposition_nickname,
+                                             'bmrbnum': bmrbnum,
+                                             'commit': [commit]}).encode()
+
+        # Splice the deposition information into the (cached) entry JSON object rather than decoding it again
+        response = Response(entry_json[:-1] + b', ' + deposition_info[1:], mimetype='application/json')
+        # Browsers revalidate with If-None-Match on every load, and get a 304 while the deposition is unchanged
+        response.set_etag('%s.%s' % (commit, schema_hash))
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
 
 @application.route('/deposition/<uuid:uuid>/saveframes', methods=('PUT',))
@@ -853,6 +1115,9 @@ def store_saveframes(uuid) -> Response:
     `_Unique_ID` tag and replaced in place. Saveframes whose IDs are not found
     are appended (this is how the client creates new saveframes — it generates
     a uuid client-side and sends it).
+
+    Response: {"commit": <commit>, "changed_saveframes": [<names of the saveframes
+    that were actually modified or added>]}
     """
     payload: dict = request.get_json()
     if not payload or 'saveframes' not in payload:
@@ -879,7 +1144,8 @@ def store_saveframes(uuid) -> Response:
         incoming_ids.append(sf_id)
 
     with depositions.DepositionRepo(uuid) as repo:
-        existing_entry: pynmrstar.Entry = repo.entry
+        # Only read from the shared cached entry - update_saveframes() builds the new entry without copying it
+        existing_entry: pynmrstar.Entry = repo.entry_read_only
 
         if repo.last_commit not in payload['commit']:
             if not payload.get('force'):
@@ -896,7 +1162,8 @@ def store_saveframes(uuid) -> Response:
             if existing_id and existing_id[0]:
                 existing_by_id[existing_id[0]] = sf
 
-        changed = False
+        replacements: Dict[str, pynmrstar.Saveframe] = {}
+        additions: List[pynmrstar.Saveframe] = []
         for sf_id, sf in zip(incoming_ids, parsed_saveframes):
             target = existing_by_id.get(sf_id)
             # Fallback: if the client minted a UUID that the server doesn't know
@@ -909,23 +1176,76 @@ def store_saveframes(uuid) -> Response:
                 target = existing_by_name.get(sf.name)
             if target is None:
                 # Genuinely new saveframe — append. Client allocated the uuid.
-                existing_entry.add_saveframe(sf)
-                changed = True
+                additions.append(sf)
             else:
                 # Replace in place. Skip the rewrite if nothing actually changed
-                # so we don't churn commits on no-op saves.
+                # so we don't churn commits on no-op saves. This compares digests
+                # of the NMR-STAR text, so only the incoming saveframe is rendered.
                 try:
-                    if target == sf:
+                    if repo.saveframe_unchanged(target.name, sf):
                         continue
-                except ValueError:
-                    pass
-                existing_entry[target.name] = sf
-                changed = True
+                except ValueError as err:
+                    raise RequestError("Invalid saveframe '%s': %s" % (sf.name, err))
+                replacements[target.name] = sf
+
+        if not replacements and not additions:
+            return jsonify({'commit': repo.last_commit, 'changed_saveframes': []})
 
-        if not changed:
-            return jsonify({'commit': repo.last_commit})
+        # Only the changed saveframes are re-rendered; the rest of entry.str is reused as is
+        try:
+            repo.update_saveframes(replacements, additions)
+        except ValueError as err:
+            raise RequestError("Invalid saveframes: %s" % err)
 
-        repo.entry = existing_entry
-        repo.commit("Entry updated (incremental).")
+        repo.commit("Entry updated (incremental).", defer=True)
 
-        return jsonify({'commit': repo.last_commit})
+        return jsonify({'commit': repo.last_commit,
+                        'changed_saveframes': [sf.name for sf in replacements.values()] +
+                                              [sf.name for sf in additions]})
+
+
+@application.route('/deposition/<uuid:uuid>/operations', methods=('POST',))
+def apply_entry_operations(uuid) -> Response:
+    """ Delta save: apply a list of fine-grained edits (set a tag or a loop cell, insert or delete a loop row,
+    add or delete a saveframe) rather than sending whole saveframes. See entry_operations.apply_operations() for
+    the supported operations.
+
+    Body: {"commit": [<known commit hashes>], "force"?: true, "operations": [<operation>, ...]}
+
+    The operations are applied in order, and either all of them or none are saved.
+
+    Response: {"commit": <commit>, "changed_saveframes": [<names of the saveframes that were modified, added
+    or deleted>]}
+    """
+    payload: dict = request.get_json()
+    if not payload or not isinstance(payload.get('operations'), list):
+        raise RequestError("Missing 'operations' in request body.")
+    if 'commit' not in payload:
+        raise RequestError("Missing 'commit' in request body.")
+
+    with depositions.DepositionRepo(uuid) as repo:
+        if repo.last_commit not in payload['commit']:
+            if not payload.get('force'):
+                logging.warning('Stale delta save for deposition %s.', uuid)
+                return jsonify({'error': 'reload'})
+
+        # Only the saveframes the operations touch are copied from the shared cached entry
+        replacements, additions, deletions = apply_operations(repo.entry_read_only, payload['operations'])
+        try:
+            replacements = {name: sf for name, sf in replacements.items() if not repo.saveframe_unchanged(name, sf)}
+        except ValueError as err:
+            raise RequestError("Invalid operations: %s" % err)
+
+        if not replacements and not additions and not deletions:
+            return jsonify({'commit': repo.last_commit, 'changed_saveframes': []})
+
+        try:
+            repo.update_saveframes(replacements, additions, deletions)
+        except ValueError as err:
+            raise RequestError("Invalid operations: %s" % err)
+
+        repo.commit("Entry updated (operations).", defer=True)
+
+        return jsonify({'commit': repo.last_commit,
+                        'changed_saveframes': [sf.name for sf in replacements.values()] +
+                                              [sf.name for sf in additions] + deletions})
@@ -65,8 +65,9 @@ def admin_search():
         # A deposited entry can only be unlocked while annotation has not yet begun, i.e. its ETS
         # status is still 'nd' (or None: no BMRB ID / ETS mocked). We resolve this up front so the
         # UI can gate the Unlock button the same way the depositor UI does, rather than offering an
-        # action the backend would only reject. The actual unlock endpoint re-checks authoritatively.
-        ets_statuses = depositions.get_ets_statuses(
+        # action the backend would only reject. The actual unlock endpoint re-checks authoritatively, so recently
+        # fetched statuses are good enough here, as are outdated ones (flagged as such) when ETS is slow.
+        ets_statuses, ets_status_outdated = depositions.get_cached_ets_statuses(
             [dep.bmrbnum for dep in results if dep.entry_deposited and dep.bmrbnum])
 
         def _unlockable(dep) -> bool:
@@ -86,6 +87,7 @@ def admin_search():
             'email_validated': bool(dep.email_validated),
             'entry_deposited': bool(dep.entry_deposited),
             'unlockable': _unlockable(dep),
+            'ets_status_outdated': dep.bmrbnum in ets_status_outdated,
         } for dep in results])
 
 
@@ -94,8 +96,9 @@ def admin_search():
 def admin_unlock_deposition(uuid):
     """ Re-open a deposited entry for editing by flipping entry_deposited back to False.
 
-    Only the metadata is mutated (which writes submission_info.json), so this deliberately does
-    not touch entry.str and therefore is not blocked by `raise_write_errors`. The assigned
+    Only the metadata is mutated (which writes submission_info.json), so this is not blocked by
+    `raise_write_errors`. entry.str is only touched once the entry is unlocked, to give legacy saveframes
+    the `_Unique_ID` tags they are missing (see `DepositionRepo.backfill_unique_ids`). The assigned
     bmrbnum is intentionally retained so a subsequent re-deposit reuses the same BMRB ID. """
 
     with depositions.DepositionRepo(uuid) as repo:
@@ -111,6 +114,8 @@ def admin_unlock_deposition(uuid):
             # Flip the ETS status to 'unlk' (recording a logtable entry) before re-opening the entry.
             repo.set_ets_status('unlk', 'Deposition unlocked for editing')
             repo.metadata['entry_deposited'] = False
+            # Deposited entries are skipped by the _Unique_ID migration, so catch them up now they are editable
+            repo.backfill_unique_ids()
             repo.commit('Manual deposition unlock by administrator')
         return jsonify({'commit': repo.last_commit,
                         'entry_deposited': repo.metadata.get('entry_deposited', False)})
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import logging
+import optparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Optional
+
+from bmrbdep.common import list_all_depositions
+from bmrbdep.depositions import DepositionRepo
+from bmrbdep.helpers.star_tools import missing_unique_ids
+
+# Specify some basic information about our command
+opt = optparse.OptionParser(usage="usage: %prog", version="1.0",
+                            description="Give every saveframe of every (non-deposited) deposition a _Unique_ID tag, "
+                                        "so that loading a deposition never has to write to it.")
+opt.add_option("--processes", action="store", type="int", dest="processes", default=None,
+               help="How many depositions to process in parallel. Defaults to the number of CPUs.")
+opt.add_option("--dry-run", action="store_true", dest="dry_run", default=False,
+               help="Only report which depositions need to be backfilled.")
+opt.add_option("--verbose", action="store_true", dest="verbose", default=False, help="Be verbose")
+
+
+def backfill_deposition(deposition_id: str, dry_run: bool) -> Tuple[str, int, Optional[str]]:
+    """ Backfill the IDs of one deposition. Returns (deposition ID, saveframes that needed an ID, error). """
+
+    try:
+        # Most depositions won't need anything, so check with a shared lock first
+        with DepositionRepo(deposition_id, read_only=True) as repo:
+            if repo.metadata.get('entry_deposited'):
+                return deposition_id, 0, None
+            missing: int = missing_unique_ids(repo.entry_read_only)
+            if not missing or dry_run:
+                return deposition_id, missing, None
+
+        # The deposition may have changed since we looked, so backfill_unique_ids() checks again
+        with DepositionRepo(deposition_id) as repo:
+            assigned: int = repo.backfill_unique_ids()
+            if assigned:
+                repo.commit("Backfilled per-saveframe unique IDs.")
+            return deposition_id, assigned, None
+    except Exception as err:
+        return deposition_id, 0, repr(err)
+
+
+if __name__ == '__main__':
+    # Parse the command line input
+    (options, cmd_input) = opt.parse_args()
+
+    logging.basicConfig()
+    logger = logging.getLogger()
+    if options.verbose:
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.WARNING)
+
+    updated, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=options.processes) as executor:
+        deposition_ids = list(list_all_depositions())
+        results = executor.map(backfill_deposition, deposition_ids, [options.dry_run] * len(deposition_ids),
+                               chunksize=16)
+        for deposition_id, assigned, error in results:
+            if error:
+                failed += 1
+                logging.error('Could not backfill deposition %s: %s' % (deposition_id, error))
+            elif assigned:
+                updated += 1
+                logging.info('%s %d saveframe ID(s) in deposition %s' %
+                             ('Would assign' if options.dry_run else 'Assigned', assigned, deposition_id))
+
+    print('%d of %d depositions %s backfilled, %d failed.' %
+          (updated, len(deposition_ids), 'need to be' if options.dry_run else 'were', failed))
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+import optparse
+
+from bmrbdep.common import configuration
+from bmrbdep.helpers.blob_store import BlobStore
+
+# Specify some basic information about our command
+opt = optparse.OptionParser(usage="usage: %prog", version="1.0",
+                            description="Remove the files in the shared data file store that no deposition links to "
+                                        "any more.")
+opt.add_option("--dry-run", action="store_true", dest="dry_run", default=False,
+               help="Only report how many files would be removed.")
+
+if __name__ == '__main__':
+    # Parse the command line input
+    (options, cmd_input) = opt.parse_args()
+
+    if not configuration.get('data_file_store'):
+        opt.error('No data_file_store is configured.')
+
+    removed: int = BlobStore(configuration['data_file_store']).collect_garbage(dry_run=options.dry_run)
+    print('%d unused file(s) %s.' % (removed, 'would be removed' if options.dry_run else 'were removed'))
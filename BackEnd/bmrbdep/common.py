@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
+import gzip
+import hashlib
 import os
 import pathlib
 import zlib
 from io import StringIO
-from typing import Union, TextIO, Tuple, Iterable, List, Optional
+from typing import Union, TextIO, Tuple, Iterable, List, Optional, Callable, Any
 
+import pynmrstar
 import simplejson as json
 import werkzeug.utils
 
 from bmrbdep.exceptions import ServerError, RequestError
+from bmrbdep.helpers.caching import LRUCache
 
 root_dir: str = os.path.dirname(os.path.realpath(__file__))
 with open(os.path.join(root_dir, 'configuration.json'), "r") as _config_file:
@@ -65,8 +69,8 @@ def is_admin_email(email: Optional[str]) -> bool:
     return normalized in {str(_).strip().lower() for _ in admins}
 
 
-def get_schema(version: str, schema_format: str = "json") -> Union[dict, TextIO]:
-    """ Return the schema from disk. """
+def _get_schema_directory() -> str:
+    """ Return the directory the schemas were generated into. """
 
     # When running locally
     schema_dir = os.path.join(root_dir, '..', 'schema', 'schema_data')
@@ -74,24 +78,83 @@ def get_schema(version: str, schema_format: str = "json") -> Union[dict, TextIO]
         schema_dir = os.path.join(root_dir, '..', 'schema_data')
         if not os.path.exists(schema_dir):
             raise IOError("No schema directory found: %s" % schema_dir)
+    return schema_dir
+
+
+# Decoded schemas, keyed by (version, format). Each value is stored alongside the (mtime, size) of the file it
+#  was loaded from, so that a schema rewritten by schema_loader.py is picked up without restarting the workers.
+_schema_cache = LRUCache(max_items=configuration.get('schema_cache_size', 16))
+
 
+def _load_cached_schema(version: str, schema_format: str, extension: str, loader: Callable[[str], Any]) -> Any:
+    """ Return the schema of the given format from the per-worker cache, (re)loading it with the loader
+    when it isn't cached yet or the file on disk has changed since it was cached. """
+
+    schema_path = os.path.join(_get_schema_directory(), version + extension)
     try:
-        if schema_format == "json":
-            with open(os.path.join(schema_dir, version + '.json.zlib'), 'rb') as schema_file:
-                schema = json.loads(zlib.decompress(schema_file.read()).decode())
-        elif schema_format == "xml":
-            # pynmrstar (the consumer) reads but never closes a passed file object, so read the
-            # content here within a context manager and hand it a StringIO to avoid leaking the handle.
-            with open(os.path.join(schema_dir, version + '.xml'), 'r') as xml_file:
-                return StringIO(xml_file.read())
-        else:
-            raise ServerError('Attempted to load invalid schema type.')
-    except IOError:
+        stat = os.stat(schema_path)
+    except OSError:
         raise RequestError("Invalid schema version.")
+    file_signature = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _schema_cache.get((version, schema_format))
+    if cached is not None and cached[0] == file_signature:
+        return cached[1]
 
+    try:
+        schema = loader(schema_path)
+    except IOError:
+        raise RequestError("Invalid schema version.")
+    _schema_cache.put((version, schema_format), (file_signature, schema))
     return schema
 
 
+def _read_json_schema(schema_path: str) -> dict:
+    with open(schema_path, 'rb') as schema_file:
+        return json.loads(zlib.decompress(schema_file.read()).decode())
+
+
+def _read_text(schema_path: str) -> str:
+    with open(schema_path, 'r') as xml_file:
+        return xml_file.read()
+
+
+def get_schema(version: str, schema_format: str = "json") -> Union[dict, TextIO]:
+    """ Return the schema from disk.
+
+    The decoded JSON schema is cached per worker and shared between requests, so callers must treat
+    the returned dictionary as read-only. """
+
+    if schema_format == "json":
+        return _load_cached_schema(version, schema_format, '.json.zlib', _read_json_schema)
+    elif schema_format == "xml":
+        # pynmrstar (the consumer) reads but never closes a passed file object, so hand it a StringIO of the
+        #  cached file contents to avoid leaking a handle.
+        return StringIO(_load_cached_schema(version, schema_format, '.xml', _read_text))
+    else:
+        raise ServerError('Attempted to load invalid schema type.')
+
+
+def _read_serialized_json_schema(schema_path: str) -> Tuple[str, bytes, bytes]:
+    with open(schema_path, 'rb') as schema_file:
+        serialized = zlib.decompress(schema_file.read())
+    return hashlib.sha256(serialized).hexdigest(), serialized, gzip.compress(serialized, compresslevel=9)
+
+
+def get_serialized_schema(version: str) -> Tuple[str, bytes, bytes]:
+    """ Return the JSON schema ready to send to a client, as a tuple of (etag, JSON bytes, gzipped JSON bytes).
+    The serialization and compression happen once per version per worker. """
+
+    return _load_cached_schema(version, 'serialized', '.json.zlib', _read_serialized_json_schema)
+
+
+def get_pynmrstar_schema(version: str) -> pynmrstar.Schema:
+    """ Return the pynmrstar.Schema for the given version. Building the schema is expensive, so the built object
+    is cached per worker and shared between requests - callers must not modify it. """
+
+    return _load_cached_schema(version, 'pynmrstar', '.xml', lambda path: pynmrstar.Schema(StringIO(_read_text(path))))
+
+
 def get_release():
     """ Returns the git branch and last commit that were present during the last release. """
 
@@ -103,7 +103,7 @@ def rescan():
                 # Load deposition data
                 with DepositionRepo(deposition_id) as deposition_repo:
                     json_data = deposition_repo.metadata
-                    entry = deposition_repo.entry
+                    entry = deposition_repo.entry_read_only
 
                     # Parse creation_date
                     creation_date = None
@@ -1,27 +1,40 @@
 #!/usr/bin/env python3
+import copy
+import hashlib
 import json
 import logging
 import os
 import pathlib
+import pickle
 import shutil
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import date, datetime, timezone
-from typing import Dict, List, BinaryIO, Optional
+from typing import Dict, List, BinaryIO, Optional, Tuple, Set, Iterable, Union, Iterator
+from uuid import uuid4
 
 import flask
 import psycopg2
+import psycopg2.extensions
 import pynmrstar
 import unidecode
 from dateutil.relativedelta import relativedelta
-from filelock import Timeout, FileLock, BaseFileLock
-from git import Repo, CacheError
+from git import Repo, CacheError, BaseIndexEntry, Blob
+from gitdb import IStream
 from sqlalchemy import select
 
-from bmrbdep.common import configuration, residue_mappings, get_release, get_schema, secure_full_path, \
-    filter_null_values, format_contact_names
+from bmrbdep.common import configuration, residue_mappings, get_release, get_pynmrstar_schema, \
+    secure_full_path, filter_null_values, format_contact_names
 from bmrbdep.exceptions import ServerError, RequestError
-from bmrbdep.helpers.pubmed import update_citation_with_pubmed
-from bmrbdep.helpers.star_tools import upgrade_chemcomps_and_create_entities_where_needed
+from bmrbdep.helpers.blob_store import BlobStore
+from bmrbdep.helpers.caching import LRUCache
+from bmrbdep.helpers.locking import LockTimeout, ReadWriteFileLock
+from bmrbdep.helpers.pubmed import PubMedCache, fetch_pubmed_records, update_citation_with_pubmed_record
+from bmrbdep.helpers.star_tools import upgrade_chemcomps_and_create_entities_where_needed, assign_unique_ids, \
+    missing_unique_ids, chemcomp_codes_to_look_up
 
 if not os.path.exists(configuration['repo_path']):
     try:
@@ -35,7 +48,7 @@ def _determine_lock_directory() -> str:
     """ Pick a directory to hold the per-deposition advisory locks.
 
     This MUST be on a local filesystem with reliable file locking. The deposition
-    repos themselves live on NFS, where filelock-based mutual exclusion is not
+    repos themselves live on NFS, where flock-based mutual exclusion is not
     dependable, so locking there let concurrent git operations collide on
     .git/index.lock. /dev/shm (tmpfs) is local, fast, and cleared on reboot - so
     stale locks never survive a crash. We fall back to the system temp directory
@@ -52,6 +65,42 @@ def _determine_lock_directory() -> str:
 
 _LOCK_DIRECTORY = _determine_lock_directory()
 
+# Uploaded data files are stored once for all depositions, and linked into each of them, if a data_file_store
+#  directory (on the same filesystem as repo_path) is configured
+_BLOB_STORE: Optional[BlobStore] = None
+if configuration.get('data_file_store'):
+    _BLOB_STORE = BlobStore(configuration['data_file_store'])
+
+# PubMed records are looked up again on every (re)deposition, so they are cached for all the workers
+_PUBMED_CACHE = PubMedCache(os.path.join(configuration['repo_path'], '.pubmed_cache'),
+                            max_age=configuration.get('pubmed_cache_days', 30) * 24 * 60 * 60,
+                            not_found_max_age=configuration.get('pubmed_not_found_cache_hours', 1) * 60 * 60)
+
+# Parsed entries, shared by every DepositionRepo opened in this worker process. Parsing entry.str is the most
+#  expensive part of most requests, so it is only done when the file changed since it was last parsed. Each value
+#  is stored with the (inode, mtime, size) signature of the entry.str it was parsed from, and the cache is bounded
+#  by the total size of those files.
+_entry_cache = LRUCache(max_items=configuration.get('entry_cache_size', 128),
+                        max_weight=configuration.get('entry_cache_megabytes', 32) * 1024 * 1024)
+
+# The NMR-STAR text of each saveframe of the cached entries, exactly as it appears in entry.str, so that saving a
+#  few changed saveframes only needs those to be rendered. Each value is the (inode, mtime, size) signature of the
+#  entry.str it belongs to, the saveframe texts, per saveframe whether it was rendered with the category comment,
+#  and the SHA-256 digests of the saveframe texts (used to detect saves that don't change anything).
+_entry_fragment_cache = LRUCache(max_items=configuration.get('entry_cache_size', 128),
+                                 max_weight=configuration.get('entry_fragment_cache_megabytes', 32) * 1024 * 1024)
+
+# Bump this whenever the layout of the binary entry sidecar changes, to invalidate the existing sidecars
+_ENTRY_SIDECAR_VERSION = 2
+
+# The JSON rendering of the entry as of each commit, as sent to the browser. Keyed by (deposition ID, commit).
+_entry_json_cache = LRUCache(max_items=configuration.get('entry_json_cache_size', 128),
+                             max_weight=configuration.get('entry_json_cache_megabytes', 64) * 1024 * 1024)
+
+
+# The ETS status codes of BMRB IDs, with when they were fetched, for get_cached_ets_statuses()
+_ets_status_cache = LRUCache(max_items=configuration.get('ets_status_cache_size', 4096))
+
 
 def ets_mocked() -> bool:
     """ Whether the entry tracking system is effectively disabled (local/dev). In that case the
@@ -61,17 +110,215 @@ def ets_mocked() -> bool:
     return configuration['debug'] and configuration['ets']['host'] == 'CHANGE_ME'
 
 
-def get_ets_connection():
-    """ Open a connection to the ETS (entry tracking system) database, raising a user-facing
-    ServerError if it is unreachable. """
+class _ETSConnectionPool:
+    """ A bounded pool of connections to the ETS database. (psycopg2's own pools open their minimum number of
+    connections up front, and close any connection returned beyond it.) """
+
+    def __init__(self, max_size: int, wait_timeout: float, **connect_arguments):
+        self._max_size: int = max_size
+        self._wait_timeout: float = wait_timeout
+        self._connect_arguments: dict = connect_arguments
+        # The idle connections, with when they were returned to the pool
+        self._idle: List[Tuple[psycopg2.extensions.connection, float]] = []
+        self._size: int = 0
+        self._condition = threading.Condition()
+
+    def get(self) -> Tuple[psycopg2.extensions.connection, Optional[float]]:
+        """ Returns a connection, and when it was last returned to the pool (None for a new connection). """
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._idle or self._size < self._max_size, self._wait_timeout):
+                raise ServerError('All the connections to the entry tracking system are in use. Please try again.')
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+        try:
+            return psycopg2.connect(**self._connect_arguments), None
+        except BaseException:
+            self._discard()
+            raise
+
+    def put(self, conn: psycopg2.extensions.connection, close: bool = False) -> None:
+        if close or conn.closed:
+            conn.close()
+            self._discard()
+        else:
+            with self._condition:
+                self._idle.append((conn, time.time()))
+                self._condition.notify()
+
+    def _discard(self) -> None:
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+
+# Connections to the ETS database, per process (uwsgi forks the workers after importing the application, and a
+#  connection can't be shared across a fork, so the pool is created on first use in each worker)
+_ets_pool: Optional[_ETSConnectionPool] = None
+_ets_pool_pid: Optional[int] = None
+
+
+def _get_ets_pool() -> _ETSConnectionPool:
+    global _ets_pool, _ets_pool_pid
+
+    if _ets_pool is None or _ets_pool_pid != os.getpid():
+        ets_configuration: dict = configuration['ets']
+        _ets_pool = _ETSConnectionPool(
+            ets_configuration.get('pool_size', 4), ets_configuration.get('connect_timeout_seconds', 10),
+            user=ets_configuration['user'], host=ets_configuration['host'], database=ets_configuration['database'],
+            connect_timeout=ets_configuration.get('connect_timeout_seconds', 10),
+            options='-c statement_timeout=%d' % (ets_configuration.get('statement_timeout_seconds', 30) * 1000))
+        _ets_pool_pid = os.getpid()
+    return _ets_pool
+
+
+def _ets_connection_alive(conn: psycopg2.extensions.connection, last_used: Optional[float]) -> bool:
+    """ Whether a pooled connection still works. Only connections that were idle for a while are checked, as the
+    server (or a firewall in between) may have dropped them. """
+
+    if conn.closed:
+        return False
+    if last_used is None or time.time() - last_used < configuration['ets'].get('health_check_seconds', 30):
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1;')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def ets_connection() -> Iterator[psycopg2.extensions.connection]:
+    """ Borrow a connection to the ETS (entry tracking system) database from the pool of this process, raising a
+    user-facing ServerError if it is unreachable. Connections that went stale are replaced transparently. Anything
+    that wasn't committed when the block ends is rolled back, and connections broken during the block are closed
+    rather than returned to the pool. """
 
+    pool: _ETSConnectionPool = _get_ets_pool()
+    conn: Optional[psycopg2.extensions.connection] = None
     try:
-        return psycopg2.connect(user=configuration['ets']['user'], host=configuration['ets']['host'],
-                                database=configuration['ets']['database'])
+        # Every idle connection may be stale (e.g. after the database restarted), so go through them all if needed
+        while conn is None:
+            conn, last_used = pool.get()
+            if not _ets_connection_alive(conn, last_used):
+                pool.put(conn, close=True)
+                conn = None
     except psycopg2.OperationalError:
         logging.exception('Could not connect to ETS database. Is the server down, or the configuration wrong?')
         raise ServerError('Could not connect to entry tracking system. Please contact us.')
 
+    try:
+        yield conn
+    finally:
+        broken: bool = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        pool.put(conn, close=broken)
+
+
+# The key of the PostgreSQL advisory lock held while assigning a BMRB ID ("BMRB" in ASCII)
+_BMRBNUM_ADVISORY_LOCK = 0x424d5242
+_BMRBNUM_ASSIGNMENT_ATTEMPTS = 3
+
+
+def _lowest_free_bmrbnum(cursor, first_id: int, end_id: int) -> Optional[int]:
+    """ Find the lowest BMRB ID in the range that isn't assigned in ETS. The configured ranges are intentionally
+    half-open: the upper bound is exclusive and is never assignable.
+
+    The candidates are the first ID of the range and every ID that directly follows an assigned one, so the
+    database does the work with index lookups, rather than every ID in the range being fetched and compared. """
+
+    cursor.execute("""
+SELECT candidate FROM (
+    SELECT %(first)s AS candidate
+     WHERE NOT EXISTS (SELECT 1 FROM entrylog WHERE bmrbnum = %(first)s)
+    UNION ALL
+    SELECT assigned.bmrbnum + 1
+      FROM entrylog AS assigned
+     WHERE assigned.bmrbnum >= %(first)s AND assigned.bmrbnum < %(end)s - 1
+       AND NOT EXISTS (SELECT 1 FROM entrylog AS following WHERE following.bmrbnum = assigned.bmrbnum + 1)
+) AS candidates
+ORDER BY candidate
+LIMIT 1;""", {'first': first_id, 'end': end_id})
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _assign_bmrbnum(conn: psycopg2.extensions.connection, ranges: List[List[int]], params: dict) -> int:
+    """ Assign the lowest free BMRB ID of the first configured range that has one, and create the entry tracking
+    record of the deposition (described by params) with it. Returns the BMRB ID. """
+
+    cur = conn.cursor()
+    bmrbnum: Optional[int] = None
+    for _ in range(_BMRBNUM_ASSIGNMENT_ATTEMPTS):
+        try:
+            # Concurrent deposits take turns, so they can't pick the same ID. The lock is released when
+            #  the transaction ends.
+            cur.execute('SELECT pg_advisory_xact_lock(%s);', [_BMRBNUM_ADVISORY_LOCK])
+
+            # Determine which bmrbnum to use - one range at a time
+            bmrbnum = None
+            for id_range in ranges:
+                bmrbnum = _lowest_free_bmrbnum(cur, id_range[0], id_range[1])
+                if bmrbnum:
+                    break
+                logging.warning('No valid IDs found in range %d to %d. Continuing to next range...' %
+                                (id_range[0], id_range[1]))
+
+            if not bmrbnum:
+                logging.error('No valid IDs remaining in any of the ranges!')
+                raise ServerError('Could not find a valid BMRB ID to assign. Please contact us.')
+
+            params['bmrbnum'] = bmrbnum
+
+            # Create the deposition record
+            insert_query = """
+INSERT INTO entrylog (depnum, bmrbnum, status, submission_date, accession_date, onhold_status, molecular_system,
+                          contact_person1, contact_person2, submit_type, source, lit_search_required, author_email,
+                          restart_id, last_updated, nmr_dep_code)
+  VALUES (nextval('depnum_seq'), %(bmrbnum)s, %(status)s, %(submission_date)s, %(accession_date)s, %(onhold_status)s,
+                                 %(molecular_system)s, %(contact_person1)s, %(contact_person2)s, %(submit_type)s,
+                                 %(source)s, %(lit_search_required)s, %(author_email)s, %(restart_id)s, %(last_updated)s,
+                                 %(restart_id)s)"""
+            cur.execute(insert_query, params)
+            log_sql = """
+INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
+  VALUES (nextval('logid_seq'),currval('depnum_seq'),'NEW DEPOSITION','nd',1,now(),'')"""
+            cur.execute(log_sql)
+            conn.commit()
+            return bmrbnum
+        except psycopg2.IntegrityError:
+            # Whatever else writes to ETS doesn't take the advisory lock, so an ID can still
+            #  be taken in between
+            logging.warning('Could not assign BMRB ID %s - it was already assigned. Trying again.', bmrbnum)
+            conn.rollback()
+
+    raise ServerError('Could not create deposition. Please try again.')
+
+
+def _fetch_ets_statuses(bmrbnums: List[int], timeout: Optional[float] = None) -> Optional[Dict[int, Optional[str]]]:
+    """ Fetch the ETS status codes of the BMRB IDs, or return None if ETS couldn't be reached (or didn't answer
+    within the timeout, in seconds). """
+
+    try:
+        with ets_connection() as conn:
+            cur = conn.cursor()
+            if timeout:
+                cur.execute('SET LOCAL statement_timeout = %s;', [int(timeout * 1000)])
+            cur.execute('SELECT bmrbnum, status FROM entrylog WHERE bmrbnum = ANY(%s);', [bmrbnums])
+            return {row[0]: (row[1].strip() if row[1] else None) for row in cur.fetchall()}
+    except ServerError:
+        return None
+    except psycopg2.Error:
+        logging.exception('Failed to batch-fetch ETS statuses for %s', bmrbnums)
+        return None
+
 
 def get_ets_statuses(bmrbnums: List[int]) -> Dict[int, Optional[str]]:
     """ Batch-fetch ETS status codes for a collection of BMRB IDs.
@@ -85,19 +332,149 @@ def get_ets_statuses(bmrbnums: List[int]) -> Dict[int, Optional[str]]:
     unique_ids = sorted({_ for _ in bmrbnums if _})
     if ets_mocked() or not unique_ids:
         return {}
+    return _fetch_ets_statuses(unique_ids) or {}
+
+
+def get_cached_ets_statuses(bmrbnums: List[int]) -> Tuple[Dict[int, Optional[str]], Set[int]]:
+    """ The same as get_ets_statuses, but for display only: statuses fetched by this process in the last
+    ets_status_cache_seconds are reused, and ETS is only given a few seconds to answer for the others.
+
+    Returns the mapping of bmrbnum -> status code, and the set of the BMRB IDs whose current status could not be
+    fetched. For those, the mapping holds the status last fetched by this process, however old, if there is one (None
+    meaning that there was no entry tracking record), and they are absent from it otherwise. Decisions (such as
+    whether an entry may be unlocked) must be based on get_ets_status() rather than on this. """
+
+    unique_ids = sorted({_ for _ in bmrbnums if _})
+    if ets_mocked() or not unique_ids:
+        return {}, set()
+
+    now: float = time.time()
+    statuses: Dict[int, Optional[str]] = {}
+    to_fetch: List[int] = []
+    for bmrbnum in unique_ids:
+        cached: Optional[Tuple[Optional[str], float]] = _ets_status_cache.get(bmrbnum)
+        if cached and now - cached[1] < configuration.get('ets_status_cache_seconds', 60):
+            statuses[bmrbnum] = cached[0]
+        else:
+            to_fetch.append(bmrbnum)
+    if not to_fetch:
+        return statuses, set()
+
+    fetched = _fetch_ets_statuses(to_fetch, timeout=configuration['ets'].get('status_timeout_seconds', 3))
+    if fetched is None:
+        for bmrbnum in to_fetch:
+            cached = _ets_status_cache.get(bmrbnum)
+            if cached:
+                statuses[bmrbnum] = cached[0]
+        return statuses, set(to_fetch)
+
+    for bmrbnum in to_fetch:
+        statuses[bmrbnum] = fetched.get(bmrbnum)
+        _ets_status_cache.put(bmrbnum, (statuses[bmrbnum], now))
+    return statuses, set()
+
+
+def prefetch_deposit_lookups(entry: pynmrstar.Entry) \
+        -> Tuple[Dict[str, dict], Dict[str, Optional[pynmrstar.Entry]]]:
+    """ Look up the PubMed records of the citations and the chem comps of the ligands of an entry that is about to be
+    deposited, in parallel. This is meant to be done before the deposition is locked, so that DepositionRepo.deposit()
+    only has to apply the results. Lookups that fail, or don't finish within deposit_lookup_timeout_seconds, are left
+    out (and noted for the annotators when the results are applied).
+
+    Returns the PubMed records (see fetch_pubmed_records()), by PubMed ID, and the chem comp entries, by PDB code.
+    Invalid PDB codes are left out of those, and the entries of the chem comps that couldn't be looked up are None.
+    """
+
+    pubmed_ids: Set[str] = set()
+    for citation in entry.get_saveframes_by_category('citations'):
+        pubmed_id: List[str] = citation.get_tag('PubMed_ID')
+        if pubmed_id and pubmed_id[0] not in pynmrstar.definitions.NULL_VALUES:
+            pubmed_ids.add(pubmed_id[0])
     try:
-        conn = get_ets_connection()
-    except ServerError:
-        return {}
-    try:
-        cur = conn.cursor()
-        cur.execute('SELECT bmrbnum, status FROM entrylog WHERE bmrbnum = ANY(%s);', [unique_ids])
-        return {row[0]: (row[1].strip() if row[1] else None) for row in cur.fetchall()}
-    except psycopg2.Error:
-        logging.exception('Failed to batch-fetch ETS statuses for %s', unique_ids)
-        return {}
-    finally:
-        conn.close()
+        chemcomp_codes: Set[str] = chemcomp_codes_to_look_up(entry)
+    except (KeyError, ValueError):
+        # The entry is invalid, which deposit() will report
+        chemcomp_codes = set()
+    if not pubmed_ids and not chemcomp_codes:
+        return {}, {}
+
+    timeout: float = configuration.get('deposit_lookup_timeout_seconds', 30)
+    executor = ThreadPoolExecutor(max_workers=configuration.get('deposit_lookup_threads', 8))
+    # The PubMed IDs are looked up together
+    pubmed_future = executor.submit(fetch_pubmed_records, pubmed_ids, _PUBMED_CACHE, timeout)
+    chemcomp_futures = {code: executor.submit(pynmrstar.Entry.from_database, 'chemcomp_' + code)
+                        for code in chemcomp_codes}
+    # Don't wait for the lookups that time out to finish
+    wait([pubmed_future] + list(chemcomp_futures.values()), timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    pubmed_records: Dict[str, dict] = {}
+    if not pubmed_future.done():
+        logging.warning('Timed out looking up the PubMed IDs %s.', sorted(pubmed_ids))
+    elif pubmed_future.exception():
+        logging.error('Failed to look up the PubMed IDs %s.', sorted(pubmed_ids), exc_info=pubmed_future.exception())
+    else:
+        pubmed_records = pubmed_future.result()
+
+    chemcomp_entries: Dict[str, Optional[pynmrstar.Entry]] = {}
+    for code, future in chemcomp_futures.items():
+        if not future.done():
+            logging.warning('Timed out looking up the chem comp %s.', code)
+            chemcomp_entries[code] = None
+        elif isinstance(future.exception(), IOError):
+            # An invalid PDB code
+            continue
+        elif future.exception():
+            logging.error('Failed to look up the chem comp %s.', code, exc_info=future.exception())
+            chemcomp_entries[code] = None
+        else:
+            chemcomp_entries[code] = future.result()
+
+    return pubmed_records, chemcomp_entries
+
+
+def _digest_saveframe_text(saveframe_text: str) -> str:
+    return hashlib.sha256(saveframe_text.encode()).hexdigest()
+
+
+def _render_saveframes(saveframes: Iterable[pynmrstar.Saveframe]) -> Tuple[List[str], List[bool]]:
+    """ Render each saveframe the way str(Entry) does, returning the texts and which of them include the
+    category comment (only the first saveframe of each category does). """
+
+    fragments: List[str] = []
+    comment_flags: List[bool] = []
+    seen_categories = set()
+    for saveframe in saveframes:
+        show_comments = saveframe.category not in seen_categories
+        seen_categories.add(saveframe.category)
+        fragments.append(saveframe.format(skip_empty_loops=False, show_comments=show_comments))
+        comment_flags.append(show_comments)
+    return fragments, comment_flags
+
+
+def _join_saveframes(entry_id: str, fragments: List[str]) -> str:
+    """ Assemble the text of an entry from the rendered saveframes - the inverse of _render_saveframes(). """
+
+    return "data_%s\n\n" % entry_id + "\n".join(fragments)
+
+
+def _flush_commit_journal_later(uuid: str, delay: float) -> None:
+    """ Commit the coalesced saves of a deposition once their window has passed, even if nothing else is written to the
+    deposition by then. If the worker goes away first (it is recycled or killed), the saves are committed the next
+    time the deposition is opened for writing instead. """
+
+    def flush() -> None:
+        try:
+            # Opening the deposition for writing commits the journal if its window has passed. Should the journal have
+            #  been replaced by a newer one in the meantime, the request that started that one scheduled its own flush.
+            with DepositionRepo(uuid):
+                pass
+        except Exception:
+            logging.exception('Could not commit the coalesced saves of deposition %s.', uuid)
+
+    timer = threading.Timer(delay, flush)
+    timer.daemon = True
+    timer.start()
 
 
 class DepositionRepo:
@@ -109,21 +486,28 @@ class DepositionRepo:
     repo multiple times to perform actions based on values from a previous opening may not longer be correct
     due to changes made in another process.
 
-    Be aware that if you use the read_only mode, you MUST NOT perform any operations
+    Opening the repo normally takes an exclusive lock. Opening it in read_only mode takes a shared lock instead,
+    so any number of readers can look at a deposition at the same time while writers wait for them (and vice
+    versa). Be aware that if you use the read_only mode, you MUST NOT perform any operations
     that change the state of the repository as a result of what you found. For example, opening a repo
     read only to check if the repo needs a change, closing the repo, opening it with write access, and then
-    making a change IS NOT ACCEPTABLE. Checking the current state to get the contents of a file or calculate a
-    statistic is acceptable. Furthermore, read_only mode does not allow performing any git related action, so
-    you cannot use .last_commit.
+    making a change IS NOT ACCEPTABLE - unless the check is repeated after reopening with write access.
+    Checking the current state to get the contents of a file or calculate a statistic is acceptable. The git
+    repository is only opened in read_only mode if .last_commit is requested, and commits are not allowed.
     """
 
     def __init__(self, uuid, initialize: bool = False, read_only: bool = False):
-        self._repo: Repo
+        self._repo: Optional[Repo] = None
         self._uuid = uuid
         self._initialize: bool = initialize
         self._read_only: bool = read_only
-        self._modified_files: bool = False
-        self._cached_entry: pynmrstar.Entry | None = None
+        # The paths (relative to the deposition directory) written or deleted since the last commit
+        self._touched_paths: Set[str] = set()
+        # The blob IDs of touched paths whose contents were already written to the object database (see store_blob)
+        self._stored_blobs: Dict[str, bytes] = {}
+        # Whether this instance created the marker that the working tree has uncommitted changes
+        self._marked_uncommitted: bool = False
+        self._pending_entry_sidecar: Optional[Tuple[str, pynmrstar.Entry, list]] = None
         self._live_metadata: dict = {}
         self._original_metadata: dict = {}
         uuids = str(uuid)
@@ -154,7 +538,7 @@ class DepositionRepo:
                     config.set_value("user", "email", "help@bmrb.io")
 
         # Create the lock object
-        self._lock_object: BaseFileLock = FileLock(self._lock_path, timeout=360)
+        self._lock_object: ReadWriteFileLock = ReadWriteFileLock(self._lock_path, timeout=360)
 
         if not self._initialize and not self._read_only:
             self._repo = Repo(self._entry_dir)
@@ -162,12 +546,26 @@ class DepositionRepo:
     def __enter__(self):
         """ Get a session cookie to use for future requests. """
 
-        if not self._read_only:
+        try:
+            self._lock_object.acquire(shared=self._read_only)
+        except LockTimeout:
+            raise ServerError('Could not get a lock on the deposition directory. This is usually because another'
+                              ' request is already in progress.')
+
+        # Commit any coalesced saves whose window has passed (or which were left behind by a crashed worker), and any
+        #  changes that a crashed worker didn't get to commit
+        if not self._read_only and not self._initialize:
             try:
-                self._lock_object.acquire()
-            except Timeout:
-                raise ServerError('Could not get a lock on the deposition directory. This is usually because another'
-                                  ' request is already in progress.')
+                journal: Optional[dict] = self._read_commit_journal()
+                interrupted: bool = os.path.exists(self._uncommitted_marker_path)
+                if journal and (interrupted or
+                                time.time() - journal['since'] >= configuration.get('commit_coalescing_seconds', 0)):
+                    self._flush_commit_journal(journal)
+                if interrupted:
+                    self._commit_interrupted_changes()
+            except BaseException:
+                self._lock_object.release()
+                raise
 
         return self
 
@@ -185,6 +583,11 @@ class DepositionRepo:
             finally:
                 self._lock_object.release()
         else:
+            try:
+                if self._repo is not None:
+                    self._repo.close()
+            finally:
+                self._lock_object.release()
             if self._live_metadata != self._original_metadata:
                 raise ServerError("Metadata edited for a deposition that was opened read-only! These changes have not"
                                   " been saved.")
@@ -200,9 +603,142 @@ class DepositionRepo:
 
     @property
     def last_commit(self) -> str:
-        if not self._repo:
-            raise ServerError("Cannot access this attribute when repo opened read only.")
-        return self._repo.head.object.hexsha
+        """ Return the revision of the deposition as given to clients. This is the hash of the last commit, unless
+        there are coalesced saves (see commit()), in which case it is the revision token of the latest save. """
+
+        if self._repo is None:
+            if not self._read_only:
+                raise ServerError("Cannot access this attribute before the repo is initialized.")
+            self._repo = Repo(self._entry_dir)
+        return self._revision_for_head(self._repo.head.object.hexsha)
+
+    @property
+    def current_revision(self) -> Optional[str]:
+        """ The same as last_commit, but resolved by reading the files under .git directly rather than through git,
+        so that it is cheap. Returns None if HEAD can't be resolved this way. """
+
+        head: Optional[str] = self.head_commit
+        return self._revision_for_head(head) if head else None
+
+    def _revision_for_head(self, head: str) -> str:
+        journal: Optional[dict] = self._read_commit_journal()
+        if journal:
+            return journal['revision']
+        # If the last commit was a flush of coalesced saves, clients know it by the token of the last of those saves
+        try:
+            with open(self._revision_alias_path, 'r') as alias_file:
+                alias: dict = json.load(alias_file)
+            if alias['commit'] == head:
+                return alias['revision']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return head
+
+    @property
+    def _commit_journal_path(self) -> str:
+        return os.path.join(self._entry_dir, '.git', 'bmrbdep', 'pending_commit.json')
+
+    @property
+    def _uncommitted_marker_path(self) -> str:
+        return os.path.join(self._entry_dir, '.git', 'bmrbdep', 'uncommitted')
+
+    def _mark_uncommitted(self) -> None:
+        """ Record that the working tree is about to be changed. The marker is removed once the changes are committed
+        (or journaled), so if it is found by the next request, a request was interrupted before it could commit. """
+
+        if not self._marked_uncommitted:
+            os.makedirs(os.path.dirname(self._uncommitted_marker_path), exist_ok=True)
+            open(self._uncommitted_marker_path, 'w').close()
+            self._marked_uncommitted = True
+
+    def _clear_uncommitted(self) -> None:
+        try:
+            os.unlink(self._uncommitted_marker_path)
+        except FileNotFoundError:
+            pass
+        self._marked_uncommitted = False
+
+    def _commit_interrupted_changes(self) -> None:
+        """ Commit the changes that an interrupted request left in the working tree. Only the paths that were touched
+        are normally committed, so these are found with a full scan of the working tree, which is only needed here. """
+
+        if self._repo is None:
+            raise ServerError('Cannot commit to a deposition that was opened read-only.')
+        for diff in self._repo.index.diff(None):
+            # A path is None on the side of a diff where the file doesn't exist
+            path: Optional[str] = diff.a_path or diff.b_path
+            if path:
+                self._touched_paths.add(path)
+        self._touched_paths.update(self._repo.untracked_files)
+        if self._touched_paths:
+            logging.warning('Committing changes to %s left uncommitted by an interrupted request: %s', self._uuid,
+                            sorted(self._touched_paths))
+        self._commit_touched_paths('Changes left uncommitted by an interrupted request.')
+
+    @property
+    def _revision_alias_path(self) -> str:
+        return os.path.join(self._entry_dir, '.git', 'bmrbdep', 'revision_alias.json')
+
+    def _read_commit_journal(self) -> Optional[dict]:
+        try:
+            with open(self._commit_journal_path, 'r') as journal_file:
+                return json.load(journal_file)
+        except FileNotFoundError:
+            return None
+
+    def _write_bookkeeping_file(self, path: str, contents: dict) -> None:
+        """ Atomically (and durably) replace one of the JSON files used to coalesce commits. """
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as bookkeeping_file:
+            json.dump(contents, bookkeeping_file)
+            bookkeeping_file.flush()
+            os.fsync(bookkeeping_file.fileno())
+        os.replace(bookkeeping_file.name, path)
+
+    def _flush_commit_journal(self, journal: dict) -> bool:
+        """ Commit the coalesced saves recorded in the journal. Clients keep knowing the resulting commit by the
+        revision token of the last of those saves. """
+
+        if self._repo is None:
+            raise ServerError('Cannot commit to a deposition that was opened read-only.')
+        self._touched_paths.update(journal['paths'])
+        committed: bool = self._commit_touched_paths(self._coalesced_message(journal['messages']))
+        if committed:
+            self._write_bookkeeping_file(self._revision_alias_path, {'commit': self._repo.head.object.hexsha,
+                                                                     'revision': journal['revision']})
+        os.unlink(self._commit_journal_path)
+        return committed
+
+    @staticmethod
+    def _coalesced_message(messages: List[str]) -> str:
+        if len(messages) == 1:
+            return messages[0]
+        return "Coalesced %d saves.\n\n%s" % (len(messages), "\n".join(messages))
+
+    @property
+    def head_commit(self) -> Optional[str]:
+        """ Return the commit hash HEAD points to by reading the ref files directly, without opening the repository
+        through git. This works in read_only mode. Returns None if HEAD can't be resolved this way. """
+
+        git_dir: str = os.path.join(self._entry_dir, '.git')
+        try:
+            with open(os.path.join(git_dir, 'HEAD'), 'r') as head_file:
+                head: str = head_file.read().strip()
+            if not head.startswith('ref: '):
+                return head or None
+            ref: str = head[5:]
+            try:
+                with open(os.path.join(git_dir, ref), 'r') as ref_file:
+                    return ref_file.read().strip() or None
+            except FileNotFoundError:
+                with open(os.path.join(git_dir, 'packed-refs'), 'r') as packed_refs:
+                    for line in packed_refs:
+                        if line.rstrip().endswith(' ' + ref):
+                            return line.split(' ')[0]
+        except FileNotFoundError:
+            pass
+        return None
 
     def _update_database_metadata(self):
         """ Update the database with current metadata. """
@@ -216,7 +752,7 @@ class DepositionRepo:
             with get_db_session() as session:
                 # Get current entry data
                 try:
-                    contact_loop = self.entry.get_loops_by_category("_Contact_Person")[0]
+                    contact_loop = self.entry_read_only.get_loops_by_category("_Contact_Person")[0]
                     author_emails = filter_null_values(contact_loop.get_tag('Email_address'))
                     author_orcids = filter_null_values(contact_loop.get_tag('ORCID'))
                     author_names = format_contact_names(contact_loop.get_tag(['Given_name', 'Family_name']))
@@ -268,8 +804,10 @@ class DepositionRepo:
         except Exception as e:
             logging.warning(f"Could not update database metadata for {self._uuid}: {e}")
 
-    def deposit(self, final_entry: pynmrstar.Entry) -> int:
-        """ Deposits an entry into ETS. """
+    def deposit(self, final_entry: pynmrstar.Entry,
+                lookups: Optional[Tuple[Dict[str, dict], Dict[str, Optional[pynmrstar.Entry]]]] = None) -> int:
+        """ Deposits an entry into ETS. The lookups are the results of prefetch_deposit_lookups(final_entry), which
+        should be done before locking the deposition - otherwise they are done here. """
 
         self.raise_write_errors()
         if not self.metadata['email_validated']:
@@ -277,7 +815,7 @@ class DepositionRepo:
         contact_emails: List[str] = final_entry.get_loops_by_category("_Contact_Person")[0].get_tag(['Email_address'])
         if self.metadata['author_email'] not in contact_emails:
             raise RequestError('At least one contact person must have the email of the original deposition creator.')
-        existing_entry_id = self.entry.entry_id
+        existing_entry_id = self.entry_read_only.entry_id
 
         if existing_entry_id != final_entry.entry_id:
             raise RequestError('Invalid deposited entry. The ID must match that of this deposition.')
@@ -285,7 +823,7 @@ class DepositionRepo:
         logging.info('Depositing deposition %s' % final_entry.entry_id)
 
         # Determine which schema version the entry is using
-        schema: pynmrstar.Schema = pynmrstar.Schema(get_schema(self.metadata['schema_version'], schema_format='xml'))
+        schema: pynmrstar.Schema = get_pynmrstar_schema(self.metadata['schema_version'])
 
         # Add tags stripped by the deposition interface
         final_entry.add_missing_tags(schema=schema)
@@ -297,13 +835,19 @@ class DepositionRepo:
         except IndexError:
             pass
 
+        if lookups is None:
+            lookups = prefetch_deposit_lookups(final_entry)
+        pubmed_records, chemcomp_entries = lookups
+
         # Assign the PubMed ID
         for citation in final_entry.get_saveframes_by_category('citations'):
-            if citation['PubMed_ID'] and citation['PubMed_ID'] != ".":
-                update_citation_with_pubmed(citation, schema=schema)
+            pubmed_id = citation['PubMed_ID'][0]
+            if pubmed_id not in pynmrstar.definitions.NULL_VALUES:
+                update_citation_with_pubmed_record(citation, pubmed_records.get(pubmed_id), schema=schema)
 
         # Generate any necessary entities from chemcomps
-        upgrade_chemcomps_and_create_entities_where_needed(final_entry, schema=schema)
+        upgrade_chemcomps_and_create_entities_where_needed(final_entry, schema=schema,
+                                                           chemcomp_entries=chemcomp_entries)
 
         for saveframe in final_entry:
             # Remove all unicode from the entry
@@ -466,7 +1010,7 @@ class DepositionRepo:
         # If they have already deposited, just keep the same BMRB ID. A pre-existing BMRB ID also
         # means this is a re-deposit (the entry was unlocked after a prior deposition), so we move
         # the ETS status back to 'nd' rather than creating a brand-new ETS record.
-        bmrbnum = self.metadata.get('bmrbnum', None)
+        bmrbnum: Optional[int] = self.metadata.get('bmrbnum', None)
         is_redeposit = bool(bmrbnum)
         if configuration['debug'] and configuration['ets']['host'] == 'CHANGE_ME' and not bmrbnum:
             bmrbnum = 999999
@@ -475,57 +1019,8 @@ class DepositionRepo:
             if is_redeposit:
                 self.set_ets_status('nd', 'Deposition re-submitted by depositor')
         else:
-            conn = get_ets_connection()
-            cur = conn.cursor()
-
-            try:
-                # Determine which bmrbnum to use - one range at a time
-                bmrbnum: Optional[int] = None
-                for id_range in ranges:
-                    # Get the existing IDs from ETS
-                    bmrb_sql: str = 'SELECT bmrbnum FROM entrylog WHERE bmrbnum >= %s AND bmrbnum <= %s;'
-                    cur.execute(bmrb_sql, [id_range[0], id_range[1]])
-
-                    # Calculate the list of valid IDs. The configured ranges are
-                    # intentionally half-open: the upper bound is exclusive and is
-                    # never assignable.
-                    existing_ids: set = set([_[0] for _ in cur.fetchall()])
-                    ids_in_range: set = set(range(id_range[0], id_range[1]))
-                    assignable_ids = sorted(list(ids_in_range.difference(existing_ids)))
-
-                    # A valid ID has been found in this range
-                    if len(assignable_ids) > 0:
-                        bmrbnum = assignable_ids[0]
-                        break
-                    else:
-                        logging.warning('No valid IDs found in range %d to %d. Continuing to next range...' %
-                                        (id_range[0], id_range[1]))
-
-                if not bmrbnum:
-                    logging.error('No valid IDs remaining in any of the ranges!')
-                    raise ServerError('Could not find a valid BMRB ID to assign. Please contact us.')
-
-                params['bmrbnum'] = bmrbnum
-
-                # Create the deposition record
-                insert_query = """
-INSERT INTO entrylog (depnum, bmrbnum, status, submission_date, accession_date, onhold_status, molecular_system,
-                      contact_person1, contact_person2, submit_type, source, lit_search_required, author_email,
-                      restart_id, last_updated, nmr_dep_code)
-  VALUES (nextval('depnum_seq'), %(bmrbnum)s, %(status)s, %(submission_date)s, %(accession_date)s, %(onhold_status)s,
-                             %(molecular_system)s, %(contact_person1)s, %(contact_person2)s, %(submit_type)s,
-                             %(source)s, %(lit_search_required)s, %(author_email)s, %(restart_id)s, %(last_updated)s,
-                             %(restart_id)s)"""
-                cur.execute(insert_query, params)
-                log_sql = """
-INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
-  VALUES (nextval('logid_seq'),currval('depnum_seq'),'NEW DEPOSITION','nd',1,now(),'')"""
-                cur.execute(log_sql)
-                conn.commit()
-            except psycopg2.IntegrityError:
-                logging.exception('Could not assign the chosen BMRB ID - it was already assigned.')
-                conn.rollback()
-                raise ServerError('Could not create deposition. Please try again.')
+            with ets_connection() as conn:
+                bmrbnum = _assign_bmrbnum(conn, ranges, params)
 
         # Assign the BMRB ID in all the appropriate places in the entry
         final_entry.entry_id = bmrbnum
@@ -552,14 +1047,11 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         bmrbnum = self.metadata.get('bmrbnum')
         if not bmrbnum:
             return None
-        conn = get_ets_connection()
-        try:
+        with ets_connection() as conn:
             cur = conn.cursor()
             cur.execute('SELECT status FROM entrylog WHERE bmrbnum = %s;', [bmrbnum])
             row = cur.fetchone()
             return row[0].strip() if row and row[0] else None
-        finally:
-            conn.close()
 
     def set_ets_status(self, new_status: str, action_description: str) -> None:
         """ Set the ETS status for this deposition's BMRB ID and record a logtable entry describing
@@ -570,64 +1062,319 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         bmrbnum = self.metadata.get('bmrbnum')
         if not bmrbnum:
             raise ServerError('Cannot update entry tracking status: this deposition has no assigned BMRB ID.')
-        conn = get_ets_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT depnum FROM entrylog WHERE bmrbnum = %s;', [bmrbnum])
-            row = cur.fetchone()
-            if not row:
-                raise ServerError('Cannot update entry tracking status: no record for BMRB ID %s.' % bmrbnum)
-            depnum = row[0]
-            cur.execute('UPDATE entrylog SET status = %s, last_updated = %s WHERE bmrbnum = %s;',
-                        [new_status, date.today().isoformat(), bmrbnum])
-            log_sql = """
+        with ets_connection() as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT depnum FROM entrylog WHERE bmrbnum = %s;', [bmrbnum])
+                row = cur.fetchone()
+                if not row:
+                    raise ServerError('Cannot update entry tracking status: no record for BMRB ID %s.' % bmrbnum)
+                depnum = row[0]
+                cur.execute('UPDATE entrylog SET status = %s, last_updated = %s WHERE bmrbnum = %s;',
+                            [new_status, date.today().isoformat(), bmrbnum])
+                log_sql = """
 INSERT INTO logtable (logid, depnum, actdesc, newstatus, statuslevel, logdate, login)
   VALUES (nextval('logid_seq'), %s, %s, %s, 1, now(), '')"""
-            cur.execute(log_sql, [depnum, action_description, new_status])
-            conn.commit()
-        except psycopg2.Error:
-            conn.rollback()
-            logging.exception('Failed to update ETS status to %s for BMRB ID %s', new_status, bmrbnum)
-            raise ServerError('Could not update the entry tracking status. Please try again.')
-        finally:
-            conn.close()
+                cur.execute(log_sql, [depnum, action_description, new_status])
+                conn.commit()
+                _ets_status_cache.pop(bmrbnum)
+            except psycopg2.Error:
+                logging.exception('Failed to update ETS status to %s for BMRB ID %s', new_status, bmrbnum)
+                raise ServerError('Could not update the entry tracking status. Please try again.')
+
+    def _entry_signature(self) -> Tuple[int, int, int]:
+        """ Return a signature of entry.str that changes whenever the file is rewritten. """
+
+        stat = os.stat(os.path.join(self._entry_dir, 'entry.str'))
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
 
     @property
-    def entry(self) -> pynmrstar.Entry:
-        """ Return the NMR-STAR entry for this entry. """
+    def _entry_sidecar_path(self) -> str:
+        # Kept inside the .git directory so that it is never committed or listed as a deposition file
+        return os.path.join(self._entry_dir, '.git', 'bmrbdep', 'entry.pickle')
+
+    def _write_entry_sidecar(self, entry: pynmrstar.Entry, digest: str, layout: Optional[list] = None) -> None:
+        """ Write a pickled copy of the entry next to entry.str, tagged with the SHA-256 of the entry.str it
+        represents. Loading the pickle is many times faster than parsing the NMR-STAR text.
+
+        The layout, when known, lists the (length, comment flag, digest) of the text of each saveframe within
+        entry.str, so that the saveframe texts can be sliced out of the file rather than rendered again. """
+
+        sidecar_path = self._entry_sidecar_path
+        os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+        try:
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(sidecar_path), delete=False) as sidecar_file:
+                pickle.dump((_ENTRY_SIDECAR_VERSION, pynmrstar.__version__, digest), sidecar_file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(entry, sidecar_file, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(layout, sidecar_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(sidecar_file.name, sidecar_path)
+        except (OSError, pickle.PicklingError) as err:
+            # The sidecar is only an optimization
+            logging.warning('Could not write the entry sidecar for %s: %s', self._uuid, err)
+
+    def _load_entry(self, signature: Tuple[int, int, int]) -> pynmrstar.Entry:
+        """ Load the entry from disk. Use the binary sidecar if it was written from the current entry.str,
+        otherwise fall back to parsing the NMR-STAR. """
+
+        with open(os.path.join(self._entry_dir, 'entry.str'), 'rb') as entry_file:
+            entry_text: bytes = entry_file.read()
+        digest: str = hashlib.sha256(entry_text).hexdigest()
+
+        try:
+            with open(self._entry_sidecar_path, 'rb') as sidecar_file:
+                if pickle.load(sidecar_file) == (_ENTRY_SIDECAR_VERSION, pynmrstar.__version__, digest):
+                    entry: pynmrstar.Entry = pickle.load(sidecar_file)
+                    layout: Optional[list] = pickle.load(sidecar_file)
+                    if layout is not None:
+                        self._cache_saveframe_texts_from_layout(signature, entry, entry_text.decode(), layout)
+                    return entry
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            logging.warning('Ignoring unreadable entry sidecar for %s: %s', self._uuid, err)
 
-        if self._cached_entry is not None:
-            return self._cached_entry
+        entry = pynmrstar.Entry.from_string(entry_text.decode())
+        # Older depositions have no sidecar yet - create it. This is safe under a shared lock too, since the sidecar
+        #  is derived from entry.str and is replaced atomically.
+        if self._lock_object.is_locked:
+            self._write_entry_sidecar(entry, digest)
+        return entry
+
+    @property
+    def entry_read_only(self) -> pynmrstar.Entry:
+        """ Return the NMR-STAR entry for this entry, without copying it.
+
+        The returned object is shared with every other request in this worker process, so it MUST NOT be
+        modified. Use `entry` to get a copy which can be modified and then saved. """
 
         entry_location = os.path.join(self._entry_dir, 'entry.str')
 
         try:
-            return pynmrstar.Entry.from_file(entry_location)
+            signature = self._entry_signature()
+            cached = _entry_cache.get(self._uuid)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            entry = self._load_entry(signature)
         except Exception as e:
             raise ServerError('Error loading an entry!\nError: %s\nEntry location:%s' % (repr(e), entry_location))
 
+        _entry_cache.put(self._uuid, (signature, entry), weight=signature[2])
+        return entry
+
+    @property
+    def entry(self) -> pynmrstar.Entry:
+        """ Return the NMR-STAR entry for this entry. Each access returns a new copy which the caller is
+        free to modify. """
+
+        return copy.deepcopy(self.entry_read_only)
+
     @entry.setter
     def entry(self, entry: pynmrstar.Entry) -> None:
         """ Save an entry in the standard place. """
 
         self.raise_write_errors()
-        self.write_file('entry.str', str(entry).encode(), root=True)
-        self._cached_entry = entry
-        self._modified_files = True
+        fragments, comment_flags = _render_saveframes(entry)
+        entry_text: str = _join_saveframes(entry.entry_id, fragments)
+        # Cache the entry as it will be read back from disk rather than the object we were given: values such as
+        #  integers and None only become the strings everyone else sees once they have been through the NMR-STAR
+        #  text, and the caller may continue to modify their object.
+        self._store_entry_text(entry_text, pynmrstar.Entry.from_string(entry_text), fragments, comment_flags)
+
+    @property
+    def _entry_json_path(self) -> str:
+        return os.path.join(self._entry_dir, '.git', 'bmrbdep', 'entry.json')
+
+    @property
+    def entry_json(self) -> bytes:
+        """ Return the entry as of the last commit, serialized as a JSON object.
+
+        The serialized JSON is cached in memory per commit, and (unless disabled with the entry_json_disk_cache
+        setting) on disk inside the .git directory, so that loading an unchanged deposition doesn't need the entry
+        to be parsed and serialized again. """
+
+        commit: str = self.last_commit
+        serialized: Optional[bytes] = _entry_json_cache.get((self._uuid, commit))
+        if serialized is not None:
+            return serialized
+
+        # The file on disk starts with the commit it was rendered from
+        use_disk_cache: bool = configuration.get('entry_json_disk_cache', True)
+        if use_disk_cache:
+            try:
+                with open(self._entry_json_path, 'rb') as json_file:
+                    if json_file.readline().rstrip() == commit.encode():
+                        serialized = json_file.read()
+            except FileNotFoundError:
+                pass
+
+        if serialized is None:
+            serialized = self.entry_read_only.get_json(serialize=True).encode()
+            if use_disk_cache and self._lock_object.is_locked:
+                try:
+                    os.makedirs(os.path.dirname(self._entry_json_path), exist_ok=True)
+                    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(self._entry_json_path),
+                                                     delete=False) as cache_file:
+                        cache_file.write(commit.encode() + b'\n')
+                        cache_file.write(serialized)
+                    os.replace(cache_file.name, self._entry_json_path)
+                except OSError as err:
+                    logging.warning('Could not write the cached entry JSON for %s: %s', self._uuid, err)
+
+        _entry_json_cache.put((self._uuid, commit), serialized, weight=len(serialized))
+        return serialized
+
+    def update_saveframes(self, replacements: Dict[str, pynmrstar.Saveframe],
+                          additions: List[pynmrstar.Saveframe], deletions: Iterable[str] = ()) -> None:
+        """ Save the entry with some of its saveframes replaced (keyed by the name of the saveframe they replace),
+        others appended, and others (given by name) deleted.
+
+        Only the replaced and added saveframes are rendered and parsed back - the text of the other saveframes is
+        reused from when the entry was last written or loaded by this worker, and their parsed objects are shared
+        with the cached entry. The result is identical to assigning the modified entry to `entry`. """
+
+        self.raise_write_errors()
+        base_entry: pynmrstar.Entry = self.entry_read_only
+        cached_fragments, cached_comment_flags, cached_digests = self._saveframe_texts()
+        # Copies, as the cached lists are shared
+        fragments: List[str] = list(cached_fragments)
+        comment_flags: List[bool] = list(cached_comment_flags)
+        digests: List[str] = list(cached_digests)
+
+        saveframes: List[pynmrstar.Saveframe] = list(base_entry)
+        deletions = set(deletions)
+        if deletions:
+            kept_positions = [position for position, saveframe in enumerate(saveframes)
+                              if saveframe.name not in deletions]
+            saveframes = [saveframes[_] for _ in kept_positions]
+            fragments = [fragments[_] for _ in kept_positions]
+            comment_flags = [comment_flags[_] for _ in kept_positions]
+            digests = [digests[_] for _ in kept_positions]
+
+        dirty = set()
+        for position, saveframe in enumerate(saveframes):
+            if saveframe.name in replacements:
+                saveframes[position] = replacements[saveframe.name]
+                dirty.add(position)
+        for saveframe in additions:
+            saveframes.append(saveframe)
+            fragments.append('')
+            comment_flags.append(False)
+            digests.append('')
+            dirty.add(len(saveframes) - 1)
+
+        # Only the first saveframe of each category is printed with the category comment, so a deletion or a
+        #  replacement with a different category can change how other saveframes must be rendered
+        seen_categories = set()
+        for position, saveframe in enumerate(saveframes):
+            show_comments = saveframe.category not in seen_categories
+            seen_categories.add(saveframe.category)
+            if show_comments != comment_flags[position]:
+                comment_flags[position] = show_comments
+                dirty.add(position)
+
+        new_entry = pynmrstar.Entry.from_scratch(base_entry.entry_id)
+        for position, saveframe in enumerate(saveframes):
+            if position in dirty:
+                fragments[position] = saveframe.format(skip_empty_loops=False, show_comments=comment_flags[position])
+                digests[position] = _digest_saveframe_text(fragments[position])
+                # Parse it back, for the same reason as in the entry setter
+                saveframe = pynmrstar.Saveframe.from_string(fragments[position])
+            new_entry.add_saveframe(saveframe)
+
+        self._store_entry_text(_join_saveframes(new_entry.entry_id, fragments), new_entry, fragments, comment_flags,
+                               digests)
+
+    def _store_entry_text(self, entry_text: str, parsed_entry: pynmrstar.Entry, fragments: List[str],
+                          comment_flags: List[bool], digests: Optional[List[str]] = None) -> None:
+        """ Write entry.str, and cache everything we know about the new contents. """
+
+        if digests is None:
+            digests = [_digest_saveframe_text(_) for _ in fragments]
+        self.write_file('entry.str', entry_text.encode(), root=True)
+        signature = self._entry_signature()
+        _entry_cache.put(self._uuid, (signature, parsed_entry), weight=signature[2])
+        _entry_fragment_cache.put(self._uuid, (signature, fragments, comment_flags, digests), weight=signature[2])
+        self._pending_entry_sidecar = (hashlib.sha256(entry_text.encode()).hexdigest(), parsed_entry,
+                                       list(zip((len(_) for _ in fragments), comment_flags, digests)))
+
+    def _saveframe_texts(self) -> Tuple[List[str], List[bool], List[str]]:
+        """ Return the text of each saveframe as it appears in entry.str, whether it includes the category comment,
+        and its digest. The returned lists are shared and MUST NOT be modified. """
+
+        entry: pynmrstar.Entry = self.entry_read_only
+        signature = self._entry_signature()
+        cached = _entry_fragment_cache.get(self._uuid)
+        if cached is not None and cached[0] == signature:
+            return cached[1], cached[2], cached[3]
+
+        fragments, comment_flags = _render_saveframes(entry)
+        digests: List[str] = [_digest_saveframe_text(_) for _ in fragments]
+        _entry_fragment_cache.put(self._uuid, (signature, fragments, comment_flags, digests), weight=signature[2])
+        return fragments, comment_flags, digests
+
+    def _cache_saveframe_texts_from_layout(self, signature: Tuple[int, int, int], entry: pynmrstar.Entry,
+                                           entry_text: str, layout: list) -> None:
+        """ Slice the text of each saveframe out of entry.str using the layout stored in the sidecar. """
+
+        fragments: List[str] = []
+        position: int = len(_join_saveframes(entry.entry_id, []))
+        for length, _, _ in layout:
+            fragments.append(entry_text[position:position + length])
+            position += length + 1
+        _entry_fragment_cache.put(self._uuid, (signature, fragments, [_[1] for _ in layout], [_[2] for _ in layout]),
+                                  weight=signature[2])
+
+    def saveframe_unchanged(self, name: str, saveframe: pynmrstar.Saveframe) -> bool:
+        """ Returns whether replacing the saveframe with the given name by the provided saveframe would leave the
+        entry as it is. This compares digests of the NMR-STAR text, so only the provided saveframe is rendered. """
+
+        fragments, comment_flags, digests = self._saveframe_texts()
+        for position, existing in enumerate(self.entry_read_only):
+            if existing.name == name:
+                return _digest_saveframe_text(saveframe.format(skip_empty_loops=False,
+                                                               show_comments=comment_flags[position])) == \
+                    digests[position]
+        return False
+
+    def changed_saveframes(self, entry: pynmrstar.Entry) -> List[str]:
+        """ Returns the names of the saveframes which would change (be added, modified, moved or removed) if the
+        entry was replaced by the provided one, by comparing the digests of their NMR-STAR text. """
+
+        fragments, comment_flags, digests = self._saveframe_texts()
+        existing: Dict[str, Tuple[int, str]] = {saveframe.name: (position, digest) for position, (saveframe, digest)
+                                                in enumerate(zip(self.entry_read_only, digests))}
+        new_fragments, _ = _render_saveframes(entry)
+        changed: List[str] = []
+        for position, (saveframe, fragment) in enumerate(zip(entry, new_fragments)):
+            if existing.pop(saveframe.name, None) != (position, _digest_saveframe_text(fragment)):
+                changed.append(saveframe.name)
+        # Whatever is left was removed
+        changed.extend(existing.keys())
+        return changed
 
     def get_file(self, path: str, root: bool = True) -> BinaryIO:
         """ Returns the current version of a file from the repo. """
 
+        try:
+            return open(self.get_file_path(path, root=root), 'rb')
+        except IOError:
+            raise RequestError('No file with that name saved for this entry.')
+
+    def get_file_path(self, path: str, root: bool = True) -> str:
+        """ Returns where the current version of a file from the repo is on disk. Files are only ever replaced by
+        renaming another file over them, so a file that was opened stays unchanged. """
+
         secured_path, secured_filename = secure_full_path(path)
         if not secured_filename:
             raise RequestError('Cannot access directories, just files.')
-        try:
-            if root:
-                return open(os.path.join(self._entry_dir, secured_filename), "rb")
-            else:
-                return open(os.path.join(self._entry_dir, 'data_files', secured_path, secured_filename), 'rb')
-        except IOError:
+        if root:
+            full_path: str = os.path.join(self._entry_dir, secured_filename)
+        else:
+            full_path = os.path.join(self._entry_dir, 'data_files', secured_path, secured_filename)
+        if not os.path.isfile(full_path):
             raise RequestError('No file with that name saved for this entry.')
+        return full_path
 
     def get_data_file_list(self) -> List[str]:
         """ Returns the list of data files associated with this deposition.
@@ -650,6 +1397,7 @@ INSERT INTO logtable (logid, depnum, actdesc, newstatus, statuslevel, logdate, l
         """ Delete a data file by name."""
 
         self.raise_write_errors()
+        self._mark_uncommitted()
 
         secured_path, secured_filename = secure_full_path(path)
         data_file_path = os.path.join(self._entry_dir, 'data_files', secured_path, secured_filename)
@@ -663,9 +1411,25 @@ INSERT INTO logtable (logid, depnum, actdesc, newstatus, statuslevel, logdate, l
             return False
         except OSError:
             raise RequestError('You must first remove any files in a directory before removing the directory itself.')
-        self._modified_files = True
+        # Git doesn't track (empty) directories, so only a removed file is a change to commit
+        self._touched_paths.add(os.path.relpath(data_file_path, self._entry_dir))
+        self._stored_blobs.pop(os.path.relpath(data_file_path, self._entry_dir), None)
         return True
 
+    def backfill_unique_ids(self) -> int:
+        """ Give every saveframe that doesn't have one a `_Unique_ID` tag. Depositions created before incremental
+        save have no IDs, and without them the per-saveframe PUTs can't be matched to saveframes. Deposited
+        entries are sealed and are left alone - they are backfilled when they are unlocked.
+
+        Returns the number of saveframes that were assigned an ID. The caller must commit. """
+
+        if self.metadata.get('entry_deposited') or not missing_unique_ids(self.entry_read_only):
+            return 0
+        entry: pynmrstar.Entry = self.entry
+        assigned: int = assign_unique_ids(entry, overwrite=False)
+        self.entry = entry
+        return assigned
+
     def raise_write_errors(self):
         """ Raises an error if the entry may not be edited. This could happen if it is already deposited, or the email
         has not been validated."""
@@ -680,12 +1444,15 @@ INSERT INTO logtable (logid, depnum, actdesc, newstatus, statuslevel, logdate, l
                    data: Optional[bytes] = None,
                    source_path: Optional[str] = None,
                    root: bool = False,
-                   move: bool = False) \
+                   move: bool = False,
+                   blob: Optional[bytes] = None) \
             -> str:
         """ Adds (or overwrites) a file to the repo. Returns the name of the written file.
 
         When a source_path is given, set move=True to move it into place via an atomic
-        rename instead of copying. The source must be on the same filesystem as the repo. """
+        rename instead of copying. The source must be on the same filesystem as the repo.
+        If the source was already written to the object database with store_blob(), pass
+        the blob ID it returned so that committing doesn't have to read the file again. """
 
         # The submission info file should always be writeable
         if filename != 'submission_info.json':
@@ -707,32 +1474,126 @@ INSERT INTO logtable (logid, depnum, actdesc, newstatus, statuslevel, logdate, l
         if not os.path.exists(os.path.dirname(full_path)):
             pathlib.Path(os.path.dirname(full_path)).mkdir(parents=True, exist_ok=True)
 
+        self._mark_uncommitted()
         # Write the data, depending on how we got it
         if data and not source_path:
-            with open(full_path, "wb") as fo:
+            # Write to a temporary file and rename it into place, so that readers never see a partially written
+            #  file and every write produces a new inode (which the entry cache relies on to notice changes)
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.join(self._entry_dir, '.git'), delete=False) as fo:
                 fo.write(data)
+            os.replace(fo.name, full_path)
         elif source_path and not data:
-            if move:
+            if move and blob and _BLOB_STORE and not root:
+                _BLOB_STORE.link_file(blob, source_path, full_path, os.path.join(self._entry_dir, '.git'))
+            elif move:
                 os.replace(source_path, full_path)
             else:
-                shutil.copy(source_path, full_path)
+                # Data files may be links to a file shared with other depositions, so never write over one in place
+                with tempfile.NamedTemporaryFile('wb', dir=os.path.join(self._entry_dir, '.git'), delete=False) as fo:
+                    with open(source_path, 'rb') as source:
+                        shutil.copyfileobj(source, fo)
+                os.replace(fo.name, full_path)
         else:
             raise ValueError('Cannot provide both data and source_path, please only provide one.')
         # Make sure the permissions of the written file are correct
         os.chmod(full_path, 0o644)
 
-        self._modified_files = True
+        relative_path: str = os.path.relpath(full_path, self._entry_dir)
+        self._touched_paths.add(relative_path)
+        if blob and source_path:
+            self._stored_blobs[relative_path] = blob
+        else:
+            self._stored_blobs.pop(relative_path, None)
 
         if root:
             return file_name
         else:
             return os.path.join(file_path, file_name)
 
-    def commit(self, message: str) -> bool:
-        """ Commits the changes to the repository with a message. """
+    def move_data_files(self, files: List[Tuple[str, str, Optional[bytes]]]) -> List[Union[str, OSError]]:
+        """ Move many staged files into the data files of the deposition at once. Each file is given as (file name,
+        staged path, blob ID or None), just like the arguments of write_file(..., move=True), and the staged files
+        must already have their final permissions.
+
+        Every directory is created once, however many files go in it, and the files are moved in parallel, as each
+        rename is a round trip to the NFS server. Returns for each file either the name it was stored under, or the
+        error that prevented moving it - one file failing doesn't stop the others. """
+
+        self.raise_write_errors()
+        self._mark_uncommitted()
+
+        destinations: List[Tuple[str, str]] = []
+        for filename, _, _ in files:
+            file_path, file_name = secure_full_path(filename)
+            destinations.append((os.path.join(file_path, file_name),
+                                 os.path.join(self._entry_dir, 'data_files', file_path, file_name)))
+        for directory in sorted({os.path.dirname(full_path) for _, full_path in destinations}):
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError:
+                # A file is in the way - moving the files meant to go in the directory will fail below
+                pass
+
+        temporary_directory: str = os.path.join(self._entry_dir, '.git')
+
+        def move(file_: Tuple[str, str, Optional[bytes]], destination: Tuple[str, str]) -> Union[str, OSError]:
+            _, source_path, blob = file_
+            name, full_path = destination
+            try:
+                if blob and _BLOB_STORE:
+                    _BLOB_STORE.link_file(blob, source_path, full_path, temporary_directory)
+                else:
+                    os.replace(source_path, full_path)
+            except OSError as err:
+                return err
+            return name
+
+        with ThreadPoolExecutor(max_workers=configuration.get('file_threads', 8)) as executor:
+            results: List[Union[str, OSError]] = list(executor.map(move, files, destinations))
+
+        for (_, _, blob), (_, full_path), result in zip(files, destinations, results):
+            if isinstance(result, OSError):
+                continue
+            relative_path: str = os.path.relpath(full_path, self._entry_dir)
+            self._touched_paths.add(relative_path)
+            if blob:
+                self._stored_blobs[relative_path] = blob
+            else:
+                self._stored_blobs.pop(relative_path, None)
+        return results
+
+    def store_blob(self, source_path: str) -> bytes:
+        """ Write the contents of a file to the object database of the repo, and return the ID of the blob. Pass
+        it to write_file() along with the file.
+
+        Git objects are immutable and written atomically, so this doesn't need the lock: uploads are hashed and
+        compressed before the lock is taken, rather than while committing. Should the upload not be committed after
+        all, the object is unreferenced and eventually removed by git gc. If the shared data file store is enabled,
+        the object is written there instead (see BlobStore). """
+
+        if self._repo is None:
+            raise ServerError('Cannot store a blob in a deposition opened read-only!')
+        if _BLOB_STORE:
+            _BLOB_STORE.add_alternate(str(self._repo.git_dir))
+            return _BLOB_STORE.store_blob(source_path)
+        with open(source_path, 'rb') as source:
+            return self._repo.odb.store(IStream(Blob.type, os.fstat(source.fileno()).st_size, source)).binsha
+
+    def commit(self, message: str, defer: bool = False) -> bool:
+        """ Commits the changes to the repository with a message.
+
+        With defer=True, and commit coalescing enabled with the commit_coalescing_seconds setting, the changes
+        (which are already in the working tree) are only recorded in a journal inside the .git directory. They are
+        committed once the window has passed (by a timer in the worker that started the journal, see
+        _flush_commit_journal_later) or commit_coalescing_max_saves saves have been made, whichever is first - or
+        along with the next commit that isn't deferred. Until then, last_commit returns a revision token standing in
+        for the commit. Deferring is meant for autosaves. """
+
+        if self._read_only:
+            raise ServerError('Cannot commit to a deposition that was opened read-only.')
 
         # No recorded changes
-        if not self._modified_files and self._live_metadata == self._original_metadata:
+        if not self._touched_paths and self._live_metadata == self._original_metadata:
             return False
 
         # Store the IP of the user making the change. We purposefully do this after checking for modified files, as we don't want
@@ -748,13 +1609,84 @@ INSERT INTO logtable (logid, depnum, actdesc, newstatus, statuslevel, logdate, l
                             json.dumps(self._live_metadata, indent=2, sort_keys=True).encode(),
                             root=True)
 
+        # Refresh the binary sidecar to match the entry being committed
+        if self._pending_entry_sidecar:
+            self._write_entry_sidecar(self._pending_entry_sidecar[1], self._pending_entry_sidecar[0],
+                                      self._pending_entry_sidecar[2])
+            self._pending_entry_sidecar = None
+
+        journal: Optional[dict] = self._read_commit_journal()
+        coalescing_window: float = configuration.get('commit_coalescing_seconds', 0)
+        new_journal: bool = False
+        if defer and coalescing_window > 0:
+            if not journal:
+                journal = {'since': time.time(), 'paths': [], 'messages': []}
+                new_journal = True
+            journal['paths'] = sorted(set(journal['paths']) | self._touched_paths)
+            journal['messages'].append(message)
+            journal['revision'] = uuid4().hex
+            if len(journal['messages']) < configuration.get('commit_coalescing_max_saves', 20) and \
+                    time.time() - journal['since'] < coalescing_window:
+                # Once the journal is written the save is safe: a crashed worker leaves the journal behind, and the
+                #  next write access to the deposition commits it
+                self._write_bookkeeping_file(self._commit_journal_path, journal)
+                self._clear_uncommitted()
+                self._touched_paths = set()
+                self._update_database_metadata()
+                if new_journal:
+                    # Allow for the clock resolution, so that the window has certainly passed
+                    _flush_commit_journal_later(str(self._uuid), coalescing_window + 1)
+                return True
+
+        if journal:
+            # Commit the journaled saves along with this one. The commit contains more than the saves the clients
+            #  know by revision token, so it isn't aliased to any of them.
+            self._touched_paths.update(journal['paths'])
+            message = self._coalesced_message(journal['messages'] + ([] if defer else [message]))
+        committed: bool = self._commit_touched_paths(message)
+        if journal:
+            os.unlink(self._commit_journal_path)
+        if committed:
+            self._update_database_metadata()
+        return committed
+
+    def _commit_touched_paths(self, message: str) -> bool:
+        """ Commit the touched paths. Returns False if the files were rewritten with the contents they already
+        had, so there was nothing to commit. """
+
+        # Stage only the paths we touched - the rest of the working tree (which may be hundreds of data files on NFS)
+        #  is never scanned. The blobs, tree and commit are all written through GitPython's object database, in this
+        #  process, rather than by running git.
+        if self._repo is None:
+            raise ServerError('Cannot commit to a deposition that was opened read-only.')
+        touched_paths: List[str] = sorted(self._touched_paths)
+        stored_blobs: Dict[str, bytes] = self._stored_blobs
+        self._touched_paths, self._stored_blobs = set(), {}
+        index = self._repo.index
+        previous_blobs: Dict[str, Optional[bytes]] = {}
+        # Paths are hashed by GitPython, entries already point to their blob
+        to_add: List[Union[str, BaseIndexEntry]] = []
+        for path in touched_paths:
+            existing_entry = index.entries.get((path, 0))
+            previous_blobs[path] = existing_entry.binsha if existing_entry else None
+            if path in stored_blobs:
+                # The blob is already in the object database, so the (possibly huge) file isn't read again
+                to_add.append(BaseIndexEntry((0o100644, stored_blobs[path], 0, path)))
+            elif os.path.lexists(os.path.join(self._entry_dir, path)):
+                to_add.append(path)
+            else:
+                # IndexFile.remove() shells out to 'git rm', so drop the entry directly
+                index.entries.pop((path, 0), None)
+        if to_add:
+            index.add(to_add, write=False)
+
         # See if they wrote the same value to an existing file
-        if not self._repo.untracked_files and not [item.a_path for item in self._repo.index.diff(None)]:
+        if all((index.entries[(path, 0)].binsha if (path, 0) in index.entries else None) == previous_blobs[path]
+               for path in touched_paths):
+            self._clear_uncommitted()
             return False
 
-        # Add the changes, commit
-        self._repo.git.add(all=True)
-        self._repo.git.commit(message=message)
-        self._update_database_metadata()
-        self._modified_files = False
+        index.write()
+        index.commit(message)
+        self._clear_uncommitted()
         return True
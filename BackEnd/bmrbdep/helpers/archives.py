@@ -0,0 +1,82 @@
+import io
+import os
+import tarfile
+import zipfile
+from typing import Iterable, Iterator, List, Tuple
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Files with these extensions are already compressed, so deflating them again only costs time
+_COMPRESSED_EXTENSIONS = {'.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.zst', '.zip', '.7z', '.rar', '.jpg',
+                          '.jpeg', '.png', '.gif', '.pdf'}
+
+
+class _StreamBuffer(io.RawIOBase):
+    """ A write-only file object that collects what is written to it until it is drained. As it can't seek or
+    tell, zipfile writes the archive sequentially (with data descriptors). """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+def stream_zip(files: Iterable[Tuple[str, str]], compress: bool = True) -> Iterator[bytes]:
+    """ Generate a zip archive of the given (name in the archive, path) files, without holding more than a chunk
+    of it in memory. Files are deflated when compress is set, unless they are compressed already. Files that
+    disappear before they are reached are left out. """
+
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, path in files:
+            try:
+                source = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            with source:
+                info = zipfile.ZipInfo.from_file(path, name)
+                if compress and os.path.splitext(name)[1].lower() not in _COMPRESSED_EXTENSIONS:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as destination:
+                    for chunk in iter(lambda: source.read(_CHUNK_SIZE), b''):
+                        destination.write(chunk)
+                        yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def stream_tar(files: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+    """ Generate an (uncompressed) tar archive of the given (name in the archive, path) files, without holding
+    more than a chunk of it in memory. Files that disappear before they are reached are left out. """
+
+    for name, path in files:
+        try:
+            source = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with source:
+            stat = os.fstat(source.fileno())
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime, info.mode = stat.st_size, int(stat.st_mtime), 0o644
+            yield info.tobuf(format=tarfile.PAX_FORMAT)
+            # Files are only replaced by renaming, so the open file can't change - but never send other than the
+            #  size in the header
+            remaining: int = stat.st_size
+            while remaining:
+                chunk: bytes = source.read(min(_CHUNK_SIZE, remaining)) or b'\0' * min(_CHUNK_SIZE, remaining)
+                remaining -= len(chunk)
+                yield chunk
+            if stat.st_size % tarfile.BLOCKSIZE:
+                yield b'\0' * (tarfile.BLOCKSIZE - stat.st_size % tarfile.BLOCKSIZE)
+    # The end of the archive
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
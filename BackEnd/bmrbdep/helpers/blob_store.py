@@ -0,0 +1,107 @@
+import os
+from typing import Iterator, List
+from uuid import uuid4
+
+from git import Blob
+from gitdb import IStream, LooseObjectDB
+
+
+class BlobStore:
+    """ A content-addressed store of data files, shared by all depositions.
+
+    Files are stored once, named by their git blob ID, under files/. The data files of the depositions are hard links
+    to the stored copies, so a file uploaded to several depositions takes up the space of one, and the link count of
+    a stored copy is its reference count: a copy with a single link is no longer used by any deposition (see
+    collect_garbage()). Because the links share an inode, a linked file must never be modified in place - only
+    replaced by renaming another file over it.
+
+    The git objects of the files are stored once too, in objects/, which each deposition repository lists in
+    .git/objects/info/alternates. Those objects are never removed, as there is no cheap way to tell whether any
+    repository's history still refers to them.
+
+    The store must be on the same filesystem as the depositions, since hard links can't cross filesystems. """
+
+    def __init__(self, path: str):
+        self._files_path: str = os.path.join(path, 'files')
+        self._objects_path: str = os.path.join(path, 'objects')
+        os.makedirs(self._files_path, exist_ok=True)
+        os.makedirs(self._objects_path, exist_ok=True)
+        self._object_database = LooseObjectDB(self._objects_path)
+
+    def _file_path(self, blob: bytes) -> str:
+        hex_blob: str = blob.hex()
+        return os.path.join(self._files_path, hex_blob[:2], hex_blob[2:])
+
+    def add_alternate(self, git_directory: str) -> None:
+        """ Make the objects of the store available to a repository. This may be called concurrently (by several
+        threads or processes) for the same repository: the alternates file is rewritten under another name and
+        renamed into place, so it is never seen half written, and it ends up listing the store once. """
+
+        alternates_path: str = os.path.join(git_directory, 'objects', 'info', 'alternates')
+        try:
+            with open(alternates_path, 'r') as alternates:
+                existing: List[str] = alternates.read().splitlines()
+        except FileNotFoundError:
+            existing = []
+        if self._objects_path in existing:
+            return
+        os.makedirs(os.path.dirname(alternates_path), exist_ok=True)
+        temporary_path: str = '%s.%s' % (alternates_path, uuid4().hex)
+        with open(temporary_path, 'w') as alternates:
+            alternates.write(''.join(line + '\n' for line in existing + [self._objects_path]))
+        os.replace(temporary_path, alternates_path)
+
+    def store_blob(self, source_path: str) -> bytes:
+        """ Write the contents of a file to the shared object database, and return the ID of the blob.
+
+        The file is read once: it is hashed while it is compressed into a temporary object, which is simply dropped
+        if the file was uploaded before. """
+
+        with open(source_path, 'rb') as source:
+            size: int = os.fstat(source.fileno()).st_size
+            return self._object_database.store(IStream(Blob.type, size, source)).binsha
+
+    def link_file(self, blob: bytes, source_path: str, destination_path: str, temporary_directory: str) -> None:
+        """ Replace the destination with a link to the stored copy of a file, given the file and its blob ID. The
+        source becomes the stored copy if there isn't one yet, otherwise it is deleted. The link is made in the
+        temporary directory and then renamed into place. """
+
+        stored_path: str = self._file_path(blob)
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+        temporary_path: str = os.path.join(temporary_directory, 'link-%s' % uuid4().hex)
+        while True:
+            try:
+                os.link(source_path, stored_path)
+            except FileExistsError:
+                pass
+            try:
+                os.link(stored_path, temporary_path)
+                break
+            except FileNotFoundError:
+                # collect_garbage() removed the stored copy in the meantime, so store it again
+                continue
+        os.replace(temporary_path, destination_path)
+        os.unlink(source_path)
+
+    def unused_files(self) -> Iterator[str]:
+        """ Yield the paths of the stored copies that no deposition links to. """
+
+        for directory, _, filenames in os.walk(self._files_path):
+            for filename in filenames:
+                path: str = os.path.join(directory, filename)
+                if os.stat(path).st_nlink == 1:
+                    yield path
+
+    def collect_garbage(self, dry_run: bool = False) -> int:
+        """ Remove the stored copies that no deposition links to. Returns how many there were. A copy that is linked
+        to again while it is removed is simply stored again, so this is safe to run at any time. """
+
+        removed: int = 0
+        for path in self.unused_files():
+            if not dry_run:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+        return removed
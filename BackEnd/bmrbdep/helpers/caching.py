@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """ A small thread-safe, per-process least-recently-used cache.
+
+    The cache is bounded by the number of items and, optionally, by a total weight (for example the
+    size in bytes of the cached values). When either bound is exceeded the least recently used items
+    are evicted. Every uwsgi worker has its own instance, so nothing stored here is shared between
+    processes - values must always be recoverable from disk. """
+
+    def __init__(self, max_items: int, max_weight: Optional[int] = None):
+        self._max_items: int = max_items
+        self._max_weight: Optional[int] = max_weight
+        self._items: OrderedDict = OrderedDict()
+        self._weight: int = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Return the value stored for the key (marking it as recently used), or the default. """
+
+        with self._lock:
+            try:
+                value, weight = self._items[key]
+            except KeyError:
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, weight: int = 1) -> None:
+        """ Store a value, evicting the least recently used items if that exceeds the bounds. A value that is
+        heavier than the whole cache is not stored at all. """
+
+        with self._lock:
+            if key in self._items:
+                self._weight -= self._items.pop(key)[1]
+            if self._max_weight is not None and weight > self._max_weight:
+                return
+            self._items[key] = (value, weight)
+            self._weight += weight
+            while len(self._items) > self._max_items or \
+                    (self._max_weight is not None and self._weight > self._max_weight):
+                self._weight -= self._items.popitem(last=False)[1][1]
+
+    def pop(self, key: Hashable) -> None:
+        """ Remove a key from the cache, if present. """
+
+        with self._lock:
+            if key in self._items:
+                self._weight -= self._items.pop(key)[1]
+
+    def clear(self) -> None:
+        """ Empty the cache. """
+
+        with self._lock:
+            self._items.clear()
+            self._weight = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
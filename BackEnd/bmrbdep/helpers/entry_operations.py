@@ -0,0 +1,178 @@
+import copy
+from typing import Dict, List, Tuple, Optional, Any, Set
+
+import pynmrstar
+
+from bmrbdep.exceptions import RequestError
+
+SaveframeChanges = Tuple[Dict[str, pynmrstar.Saveframe], List[pynmrstar.Saveframe], List[str]]
+
+# The arguments each operation must have
+_REQUIRED_ARGUMENTS: Dict[str, Tuple[str, ...]] = {
+    'set_tag': ('saveframe', 'tag'),
+    'set_loop_cell': ('saveframe', 'loop', 'row', 'tag'),
+    'insert_row': ('saveframe', 'loop'),
+    'delete_row': ('saveframe', 'loop', 'row'),
+    'add_saveframe': ('data',),
+    'delete_saveframe': ('saveframe',),
+}
+
+
+class _OperationState:
+    """ Tracks the saveframes touched by a list of operations. Saveframes of the entry are copied the first time an
+    operation modifies them, so the entry itself is never modified. """
+
+    def __init__(self, entry: pynmrstar.Entry):
+        self.entry_frames: Dict[str, pynmrstar.Saveframe] = {}
+        self.entry_frames_by_id: Dict[str, str] = {}
+        for saveframe in entry:
+            self.entry_frames[saveframe.name] = saveframe
+            unique_id = saveframe.get_tag('_Unique_ID')
+            if unique_id and unique_id[0]:
+                self.entry_frames_by_id[unique_id[0]] = saveframe.name
+        self.copies: Dict[str, pynmrstar.Saveframe] = {}
+        self.added: List[pynmrstar.Saveframe] = []
+        self.deleted: Set[str] = set()
+
+    def _find_added(self, reference: str) -> Optional[pynmrstar.Saveframe]:
+        for saveframe in self.added:
+            unique_id = saveframe.get_tag('_Unique_ID')
+            if saveframe.name == reference or (unique_id and unique_id[0] == reference):
+                return saveframe
+        return None
+
+    def _find_entry_frame(self, reference: str) -> Optional[str]:
+        name = self.entry_frames_by_id.get(reference, reference)
+        if name in self.entry_frames and name not in self.deleted:
+            return name
+        return None
+
+    def get_saveframe(self, reference: str) -> pynmrstar.Saveframe:
+        """ Return a modifiable saveframe, by _Unique_ID or by name. """
+
+        added = self._find_added(reference)
+        if added is not None:
+            return added
+        name = self._find_entry_frame(reference)
+        if name is None:
+            raise RequestError("No saveframe '%s' exists." % reference)
+        if name not in self.copies:
+            self.copies[name] = copy.deepcopy(self.entry_frames[name])
+        return self.copies[name]
+
+    def add_saveframe(self, saveframe: pynmrstar.Saveframe) -> None:
+        unique_id = saveframe.get_tag('_Unique_ID')
+        if not unique_id or not unique_id[0]:
+            raise RequestError("Saveframe '%s' is missing a _Unique_ID tag." % saveframe.name)
+        if self._find_entry_frame(saveframe.name) or self._find_added(saveframe.name) or \
+                self._find_entry_frame(unique_id[0]) or self._find_added(unique_id[0]):
+            raise RequestError("A saveframe named '%s' (or with the same _Unique_ID) already exists." % saveframe.name)
+        self.added.append(saveframe)
+
+    def delete_saveframe(self, reference: str) -> None:
+        added = self._find_added(reference)
+        if added is not None:
+            self.added.remove(added)
+            return
+        name = self._find_entry_frame(reference)
+        if name is None:
+            raise RequestError("No saveframe '%s' exists." % reference)
+        self.deleted.add(name)
+        self.copies.pop(name, None)
+
+    def changes(self) -> SaveframeChanges:
+        return self.copies, self.added, sorted(self.deleted)
+
+
+def _get_value(operation: dict) -> Optional[str]:
+    value: Any = operation.get('value')
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise RequestError('Tag values must be strings or null.')
+
+
+def _get_loop(state: _OperationState, operation: dict) -> pynmrstar.Loop:
+    saveframe = state.get_saveframe(operation['saveframe'])
+    try:
+        return saveframe.get_loop(operation['loop'])
+    except KeyError:
+        raise RequestError("Saveframe '%s' has no loop '%s'." % (saveframe.name, operation['loop']))
+
+
+def _get_row(loop: pynmrstar.Loop, operation: dict, inserting: bool = False) -> int:
+    row = operation.get('row', len(loop.data) if inserting else None)
+    if not isinstance(row, int) or isinstance(row, bool) or row < 0 or \
+            row > len(loop.data) - (0 if inserting else 1):
+        raise RequestError("Invalid row %s for loop '%s'." % (row, loop.category))
+    return row
+
+
+def _get_column(loop: pynmrstar.Loop, tag: str) -> int:
+    column = loop.tag_index(tag)
+    if column is None:
+        raise RequestError("Loop '%s' has no tag '%s'." % (loop.category, tag))
+    return column
+
+
+def _apply_operation(state: _OperationState, operation: dict) -> None:
+    kind = operation.get('op')
+    if kind not in _REQUIRED_ARGUMENTS:
+        raise RequestError("Unknown operation '%s'." % kind)
+    for argument in _REQUIRED_ARGUMENTS[kind]:
+        if argument not in operation:
+            raise RequestError("The %s operation is missing the '%s' argument." % (kind, argument))
+
+    if kind == 'set_tag':
+        state.get_saveframe(operation['saveframe']).add_tag(operation['tag'], _get_value(operation), update=True)
+    elif kind == 'set_loop_cell':
+        loop = _get_loop(state, operation)
+        loop.data[_get_row(loop, operation)][_get_column(loop, operation['tag'])] = _get_value(operation)
+    elif kind == 'insert_row':
+        loop = _get_loop(state, operation)
+        row: List[Optional[str]] = [None] * len(loop.tags)
+        for tag, value in (operation.get('values') or {}).items():
+            row[_get_column(loop, tag)] = _get_value({'value': value})
+        loop.data.insert(_get_row(loop, operation, inserting=True), row)
+    elif kind == 'delete_row':
+        loop = _get_loop(state, operation)
+        del loop.data[_get_row(loop, operation)]
+    elif kind == 'add_saveframe':
+        try:
+            saveframe = pynmrstar.Saveframe.from_json(operation['data'])
+        except (KeyError, ValueError, TypeError) as err:
+            raise RequestError('The saveframe to add is not valid saveframe JSON: %s' % repr(err))
+        state.add_saveframe(saveframe)
+    elif kind == 'delete_saveframe':
+        state.delete_saveframe(operation['saveframe'])
+
+
+def apply_operations(entry: pynmrstar.Entry, operations: List[dict]) -> SaveframeChanges:
+    """ Apply a list of fine-grained edit operations to an entry, without modifying the entry.
+
+    Each operation is a dictionary with an 'op' key and the arguments of the operation. Saveframes are referred to
+    by their _Unique_ID (or, failing that, by name), loops by their category, and rows by their position:
+
+    {"op": "set_tag", "saveframe": ..., "tag": ..., "value": ...}
+    {"op": "set_loop_cell", "saveframe": ..., "loop": ..., "row": ..., "tag": ..., "value": ...}
+    {"op": "insert_row", "saveframe": ..., "loop": ..., "row"?: ..., "values": {<tag>: <value>, ...}}
+    {"op": "delete_row", "saveframe": ..., "loop": ..., "row": ...}
+    {"op": "add_saveframe", "data": <saveframe JSON>}
+    {"op": "delete_saveframe", "saveframe": ...}
+
+    Returns the changes as expected by DepositionRepo.update_saveframes(): the modified copies of the entry's
+    saveframes (keyed by name), the added saveframes and the names of the deleted saveframes. Either every operation
+    is valid or a RequestError is raised. """
+
+    state = _OperationState(entry)
+    for position, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise RequestError('Operation %d is not an object.' % position)
+        try:
+            _apply_operation(state, operation)
+        except RequestError as err:
+            raise RequestError('Operation %d is invalid: %s' % (position, err.message))
+        except (ValueError, TypeError) as err:
+            raise RequestError('Operation %d is invalid: %s' % (position, err))
+    return state.changes()
@@ -0,0 +1,80 @@
+import fcntl
+import os
+import threading
+import time
+from typing import Optional
+
+
+class LockTimeout(Exception):
+    """ Raised when a lock could not be acquired within the timeout. """
+    pass
+
+
+class ReadWriteFileLock:
+    """ An advisory reader/writer lock backed by flock() on a lock file.
+
+    Any number of holders may share the lock at the same time, but an exclusive holder excludes everybody else.
+    flock() locks belong to the open file description, so each instance opens its own descriptor - two instances
+    in the same process exclude each other just like two processes do. The lock file must be on a local
+    filesystem.
+
+    Like filelock.FileLock, the lock is reentrant per object: acquiring it again while it is held only increments
+    a counter, and it is released when release() has been called as many times as acquire(). """
+
+    def __init__(self, path: str, timeout: float = 360, poll_interval: float = 0.05):
+        self._path: str = path
+        self._timeout: float = timeout
+        self._poll_interval: float = poll_interval
+        self._fd: Optional[int] = None
+        self._shared: bool = False
+        self._depth: int = 0
+        self._thread_lock = threading.Lock()
+
+    @property
+    def is_locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, shared: bool = False) -> None:
+        """ Take the lock, shared or exclusive, waiting at most the timeout for any conflicting holder to
+        release it. """
+
+        with self._thread_lock:
+            if self._fd is not None:
+                if self._shared and not shared:
+                    raise RuntimeError('Cannot upgrade the shared lock on %s to an exclusive lock.' % self._path)
+                self._depth += 1
+                return
+
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            operation = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+            deadline = time.monotonic() + self._timeout
+            while True:
+                try:
+                    fcntl.flock(fd, operation)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        os.close(fd)
+                        raise LockTimeout('Timed out waiting for the lock on %s.' % self._path)
+                    time.sleep(self._poll_interval)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            self._fd = fd
+            self._shared = shared
+            self._depth = 1
+
+    def release(self) -> None:
+        """ Release the lock, if held. """
+
+        with self._thread_lock:
+            if self._fd is None:
+                return
+            self._depth -= 1
+            if self._depth > 0:
+                return
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self._fd)
+                self._fd = None
@@ -1,12 +1,29 @@
 #!/usr/bin/python3
 
+import json
 import logging
+import os
+import time
 import xml.etree.ElementTree as ElementTree
+from typing import Dict, Iterable, List, Optional
+from uuid import uuid4
 
 import pynmrstar
 import requests
+from requests.adapters import HTTPAdapter
 from unidecode import unidecode
 
+_EFETCH_URL = "https://www.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+# How many PubMed IDs are fetched per request
+_BATCH_SIZE = 200
+_CACHE_VERSION = 1
+
+_NOT_FOUND = 'Invalid or not yet released PubMed ID'
+
+# Keep the connections to PubMed open between lookups (and lookups running in parallel)
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
 
 def _safe_unidecode(item):
     if item is None:
@@ -25,56 +42,62 @@ def _get_tag_value(tag_name, root=None):
         return "."
 
 
-def update_citation_with_pubmed(citation_saveframe: pynmrstar.Saveframe,
-                                schema: pynmrstar.Schema = None):
-    """ Modifies the citation saveframe passed in to add in information loaded from PubMed. """
+class PubMedCache:
+    """ An on-disk cache of the PubMed records returned by fetch_pubmed_records(), one JSON file per PubMed ID.
+    Records of IDs that PubMed doesn't know (which may be IDs that aren't released yet) are kept for a shorter time
+    than those of articles. Errors are never cached. """
 
-    pubmed_id = citation_saveframe.get_tag('PubMed_ID')[0]
+    def __init__(self, path: str, max_age: float, not_found_max_age: float):
+        self.path: str = path
+        self.max_age: float = max_age
+        self.not_found_max_age: float = not_found_max_age
+        os.makedirs(path, exist_ok=True)
 
-    if not pubmed_id or pubmed_id == ".":
-        return
+    def get(self, pubmed_id: str) -> Optional[dict]:
+        """ Return the cached record of the PubMed ID, if there is one that hasn't expired. """
 
-    # Get whatever schema will be used for these actions
-    schema = pynmrstar.utils.get_schema(schema)
+        try:
+            with open(os.path.join(self.path, '%s.json' % pubmed_id), 'r') as cache_file:
+                cached: dict = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable cached PubMed record %s: %s', pubmed_id, err)
+            return None
+        if cached.get('version') != _CACHE_VERSION:
+            return None
+        max_age: float = self.not_found_max_age if 'error' in cached['record'] else self.max_age
+        if time.time() - cached['fetched'] > max_age:
+            return None
+        return cached['record']
 
-    # Get the XML
-    req = requests.get("https://www.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=%s"
-                       "&retmode=xml&tool=bmrbcitationparser&email=help@bmrb.io" % pubmed_id)
+    def put(self, pubmed_id: str, record: dict) -> None:
+        """ Cache the record of the PubMed ID. The file is written under another name and renamed into place, so that
+        it is never read half written. """
 
-    try:
-        root = ElementTree.fromstring(req.text)
-    except ElementTree.ParseError:
-        logging.exception('Could not get the information for the PubMed ID!')
-        citation_saveframe.add_tag('Note_to_annotator', "API Error: %s" % req.text)
-        return
-    for error in root.iter('ERROR'):
-        if 'ID list is empty' in error.text:
-            logging.warning("Invalid or not yet released PubMed ID. Cannot update citation saveframe.")
-            citation_saveframe.add_tag('Note_to_annotator', 'Invalid or not yet released PubMed ID')
-        else:
-            logging.exception('PubMed API threw exception: %s' % error.text)
-            citation_saveframe.add_tag('Note_to_annotator', "API Error: %s" % error.text)
-        return
+        temporary_path: str = os.path.join(self.path, '.%s.json' % uuid4().hex)
+        try:
+            with open(temporary_path, 'w') as cache_file:
+                json.dump({'version': _CACHE_VERSION, 'fetched': time.time(), 'record': record}, cache_file)
+            os.replace(temporary_path, os.path.join(self.path, '%s.json' % pubmed_id))
+        except OSError as err:
+            # The cache is only an optimization
+            logging.warning('Could not cache PubMed record %s: %s', pubmed_id, err)
+            try:
+                os.unlink(temporary_path)
+            except FileNotFoundError:
+                pass
 
-    # We will fill a new loop with the author info
-    author_loop = pynmrstar.Loop.from_scratch()
-    author_loop.add_tag(['_Citation_author.Ordinal',
-                         '_Citation_author.Given_name',
-                         '_Citation_author.Family_name',
-                         '_Citation_author.First_initial',
-                         '_Citation_author.Middle_initials',
-                         '_Citation_author.Family_title'])
 
-    citation_saveframe["Status"] = "published"
-    citation_saveframe["Type"] = "journal"
-    if '_Citation_author' in citation_saveframe:
-        citation_saveframe['_Citation_author'] = author_loop
-    else:
-        citation_saveframe.add_loop(author_loop)
+def _parse_article(article: ElementTree.Element) -> dict:
+    """ Extract the authors and the citation tags from the XML of one PubMed article. """
+
+    record: dict = {'authors': [], 'tags': {}}
+    tags: dict = record['tags']
 
     try:
         # Figure out the authors
-        for author in root.iter('Author'):
+        for author in article.iter('Author'):
             author_dict = {'first': ".", 'last': "."}
             for child in author:
                 if child.tag == "LastName":
@@ -98,37 +121,34 @@ def update_citation_with_pubmed(citation_saveframe: pynmrstar.Saveframe,
                 if child.tag == "Suffix":
                     author_dict['family_title'] = _safe_unidecode(child.text)
 
-            author_loop.add_data([0, author_dict['first'], author_dict['last'], author_dict.get('first_initial', "."),
-                                  author_dict.get('middle_initial', "."), author_dict.get('family_title', ".")])
-
-        # Renumber the authors and add the other tags
-        author_loop.renumber_rows('_Citation_author.Ordinal')
-        author_loop.add_missing_tags(schema=schema)
+            record['authors'].append([author_dict['first'], author_dict['last'],
+                                      author_dict.get('first_initial', "."), author_dict.get('middle_initial', "."),
+                                      author_dict.get('family_title', ".")])
 
         # Set some simple tags
-        citation_saveframe.add_tag('Title', _get_tag_value('ArticleTitle', root=root), update=True)
-        citation_saveframe.add_tag('Journal_abbrev', _get_tag_value('ISOAbbreviation', root=root), update=True)
-        citation_saveframe.add_tag('Journal_name_full', _get_tag_value('Title', root=root), update=True)
-        citation_saveframe.add_tag('Journal_volume', _get_tag_value('Volume', root=root), update=True)
-        citation_saveframe.add_tag('Journal_issue', _get_tag_value('Issue', root=root), update=True)
-        citation_saveframe.add_tag('Journal_ISSN', _get_tag_value('ISSN', root=root), update=True)
+        tags['Title'] = _get_tag_value('ArticleTitle', root=article)
+        tags['Journal_abbrev'] = _get_tag_value('ISOAbbreviation', root=article)
+        tags['Journal_name_full'] = _get_tag_value('Title', root=article)
+        tags['Journal_volume'] = _get_tag_value('Volume', root=article)
+        tags['Journal_issue'] = _get_tag_value('Issue', root=article)
+        tags['Journal_ISSN'] = _get_tag_value('ISSN', root=article)
 
         # DOI requires a bit of checking
-        for article_id in root.iter('ArticleId'):
+        for article_id in article.iter('ArticleId'):
             if article_id.attrib.get('IdType', None) == "doi":
-                citation_saveframe.add_tag('DOI', article_id.text, update=True)
+                tags['DOI'] = article_id.text
                 break
 
         # Might need to check MedlineDate for the next field as well
         try:
-            year = _get_tag_value('Year', root=next(root.iter('PubDate')))
+            year = _get_tag_value('Year', root=next(article.iter('PubDate')))
         except (ValueError, ElementTree.ParseError, StopIteration):
             logging.warning("Had to fallback to MedlineDate as Year not available in PubMed XML.")
-            year = _get_tag_value('MedlineDate', root=root).split()[0]
-        citation_saveframe.add_tag('Year', year, update=True)
+            year = _get_tag_value('MedlineDate', root=article).split()[0]
+        tags['Year'] = year
 
         # Get the pages (remove spaces first, then split on -)
-        pgn = _get_tag_value('MedlinePgn', root=root)
+        pgn = _get_tag_value('MedlinePgn', root=article)
         first_page, last_page = ".", "."
 
         if pgn is not None:
@@ -147,12 +167,140 @@ def update_citation_with_pubmed(citation_saveframe: pynmrstar.Saveframe,
             else:
                 first_page, last_page = pgn, pgn
 
-        citation_saveframe.add_tag('Page_first', first_page, update=True)
-        citation_saveframe.add_tag('Page_last', last_page, update=True)
+        tags['Page_first'] = first_page
+        tags['Page_last'] = last_page
 
     except ValueError as e:
         logging.exception('Something went wrong when generating citation from PubMed data: %s' % e)
 
+    return record
+
+
+def parse_pubmed_xml(pubmed_ids: List[str], pubmed_xml: str) -> Dict[str, dict]:
+    """ Parse the response of PubMed to a request for the records of the PubMed IDs. Returns the record of each ID:
+    the authors and citation tags of the article, or an 'error' for the annotators instead. IDs that PubMed returned
+    nothing for get the error _NOT_FOUND. """
+
+    try:
+        root = ElementTree.fromstring(pubmed_xml)
+    except ElementTree.ParseError:
+        logging.exception('Could not get the information for the PubMed ID!')
+        return {pubmed_id: {'error': "API Error: %s" % pubmed_xml} for pubmed_id in pubmed_ids}
+    for error in root.iter('ERROR'):
+        if 'ID list is empty' in error.text:
+            logging.warning("Invalid or not yet released PubMed ID. Cannot update citation saveframe.")
+            return {pubmed_id: {'error': _NOT_FOUND} for pubmed_id in pubmed_ids}
+        logging.error('PubMed API threw exception: %s' % error.text)
+        return {pubmed_id: {'error': "API Error: %s" % error.text} for pubmed_id in pubmed_ids}
+
+    records: Dict[str, dict] = {}
+    for article in root:
+        if article.tag not in ('PubmedArticle', 'PubmedBookArticle'):
+            continue
+        pmid = next(article.iter('PMID'), None)
+        if pmid is not None and pmid.text in pubmed_ids:
+            records[pmid.text] = _parse_article(article)
+    for pubmed_id in pubmed_ids:
+        if pubmed_id not in records:
+            logging.warning("Invalid or not yet released PubMed ID %s.", pubmed_id)
+            records[pubmed_id] = {'error': _NOT_FOUND}
+    return records
+
+
+def fetch_pubmed_records(pubmed_ids: Iterable[str], cache: Optional[PubMedCache] = None,
+                         timeout: Optional[float] = 30) -> Dict[str, dict]:
+    """ Look up the PubMed IDs, as parse_pubmed_xml() describes, using the records in the cache when there are any.
+    Those that aren't cached are fetched together, a batch at a time. IDs that PubMed couldn't be reached for are left
+    out. """
+
+    records: Dict[str, dict] = {}
+    to_fetch: List[str] = []
+    for pubmed_id in sorted(set(pubmed_ids)):
+        if not pubmed_id.isdigit():
+            records[pubmed_id] = {'error': _NOT_FOUND}
+            continue
+        cached: Optional[dict] = cache.get(pubmed_id) if cache else None
+        if cached is not None:
+            records[pubmed_id] = cached
+        else:
+            to_fetch.append(pubmed_id)
+
+    for position in range(0, len(to_fetch), _BATCH_SIZE):
+        batch: List[str] = to_fetch[position:position + _BATCH_SIZE]
+        try:
+            req = _session.get(_EFETCH_URL, params={'db': 'pubmed', 'id': ','.join(batch), 'retmode': 'xml',
+                                                    'tool': 'bmrbcitationparser', 'email': 'help@bmrb.io'},
+                               timeout=timeout)
+        except requests.RequestException:
+            logging.exception('Could not reach PubMed to look up the PubMed IDs %s.', batch)
+            continue
+        if req.status_code != 200:
+            logging.error('PubMed returned HTTP %s for the PubMed IDs %s.', req.status_code, batch)
+            continue
+
+        fetched: Dict[str, dict] = parse_pubmed_xml(batch, req.text)
+        for pubmed_id, record in fetched.items():
+            if cache and (record.get('error') in (None, _NOT_FOUND)):
+                cache.put(pubmed_id, record)
+        records.update(fetched)
+
+    return records
+
+
+def update_citation_with_pubmed(citation_saveframe: pynmrstar.Saveframe,
+                                schema: pynmrstar.Schema = None):
+    """ Modifies the citation saveframe passed in to add in information loaded from PubMed. """
+
+    pubmed_id = citation_saveframe.get_tag('PubMed_ID')[0]
+
+    if not pubmed_id or pubmed_id == ".":
+        return
+
+    update_citation_with_pubmed_record(citation_saveframe, fetch_pubmed_records([pubmed_id]).get(pubmed_id),
+                                       schema=schema)
+
+
+def update_citation_with_pubmed_record(citation_saveframe: pynmrstar.Saveframe, record: Optional[dict],
+                                       schema: pynmrstar.Schema = None):
+    """ Modifies the citation saveframe passed in to add in the information in the PubMed record, as returned by
+    fetch_pubmed_records(). A record of None means that PubMed couldn't be reached. """
+
+    if record is None:
+        citation_saveframe.add_tag('Note_to_annotator', 'API Error: PubMed could not be reached', update=True)
+        return
+    if 'error' in record:
+        citation_saveframe.add_tag('Note_to_annotator', record['error'], update=True)
+        return
+
+    # Get whatever schema will be used for these actions
+    schema = pynmrstar.utils.get_schema(schema)
+
+    # We will fill a new loop with the author info
+    author_loop = pynmrstar.Loop.from_scratch()
+    author_loop.add_tag(['_Citation_author.Ordinal',
+                         '_Citation_author.Given_name',
+                         '_Citation_author.Family_name',
+                         '_Citation_author.First_initial',
+                         '_Citation_author.Middle_initials',
+                         '_Citation_author.Family_title'])
+
+    citation_saveframe["Status"] = "published"
+    citation_saveframe["Type"] = "journal"
+    if '_Citation_author' in citation_saveframe:
+        citation_saveframe['_Citation_author'] = author_loop
+    else:
+        citation_saveframe.add_loop(author_loop)
+
+    for author in record['authors']:
+        author_loop.add_data([0] + author)
+
+    # Renumber the authors and add the other tags
+    author_loop.renumber_rows('_Citation_author.Ordinal')
+    author_loop.add_missing_tags(schema=schema)
+
+    for tag, value in record['tags'].items():
+        citation_saveframe.add_tag(tag, value, update=True)
+
     # Do character validation
     for tag in citation_saveframe.tag_iterator():
         citation_saveframe.add_tag(tag[0], _safe_unidecode(tag[1]), update=True)
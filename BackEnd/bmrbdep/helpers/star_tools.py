@@ -1,4 +1,6 @@
+import copy
 import re
+from typing import Dict, List, Optional, Set
 from uuid import uuid4
 
 import pynmrstar
@@ -22,6 +24,17 @@ def assign_unique_ids(entry: pynmrstar.Entry, overwrite: bool = False) -> int:
     return assigned
 
 
+def missing_unique_ids(entry: pynmrstar.Entry) -> int:
+    """ Returns how many saveframes in `entry` lack a `_Unique_ID` tag (without modifying the entry). """
+
+    missing = 0
+    for saveframe in entry:
+        existing = saveframe.get_tag('_Unique_ID')
+        if not existing or not existing[0]:
+            missing += 1
+    return missing
+
+
 def _sort_saveframes(sort_list: list) -> list:
     """ Sort the given iterable in the way that humans expect.
 
@@ -148,11 +161,8 @@ def create_entity_for_saveframe_and_attach(parent_entry: pynmrstar.Entry, savefr
     return new_entity.name
 
 
-def upgrade_chemcomps_and_create_entities_where_needed(entry: pynmrstar.Entry, schema: pynmrstar.Schema) -> None:
-    """ Generates an entity saveframe for each chem comp saveframe. """
-
-    # Store a mapping of chem_comp name to new entity name
-    chem_comp_entity_map = {}
+def _chemcomps_needing_entities(entry: pynmrstar.Entry) -> List[pynmrstar.Saveframe]:
+    """ Returns the chem comp saveframes that are part of the assembly, and so need an entity. """
 
     need_linking = []
     linked_items = set(entry.get_tag('_Entity_assembly.Entity_label'))
@@ -161,13 +171,46 @@ def upgrade_chemcomps_and_create_entities_where_needed(entry: pynmrstar.Entry, s
         linked_saveframe = entry.get_saveframe_by_name(linked_item[1:])
         if linked_saveframe.category == 'chem_comp':
             need_linking.append(linked_saveframe)
-    need_linking = _sort_saveframes(list(need_linking))
+    return _sort_saveframes(list(need_linking))
+
+
+def chemcomp_codes_to_look_up(entry: pynmrstar.Entry) -> Set[str]:
+    """ Returns the PDB codes of the chem comps that upgrade_chemcomps_and_create_entities_where_needed() will look
+    up in the BMRB database. """
+
+    return {saveframe['PDB_code'][0].upper() for saveframe in _chemcomps_needing_entities(entry)
+            if 'PDB_code' in saveframe and saveframe['PDB_code'][0] not in pynmrstar.definitions.NULL_VALUES}
+
+
+def upgrade_chemcomps_and_create_entities_where_needed(
+        entry: pynmrstar.Entry, schema: pynmrstar.Schema,
+        chemcomp_entries: Optional[Dict[str, Optional[pynmrstar.Entry]]] = None) -> None:
+    """ Generates an entity saveframe for each chem comp saveframe. The chem comps with a PDB code are looked up in
+    the BMRB database, unless the entries of the chem comps, by PDB code, were already fetched and are given. In that
+    case, a PDB code that is missing from them is treated as an invalid one, and one whose entry is None as one that
+    couldn't be looked up (e.g. because the database couldn't be reached). """
+
+    # Store a mapping of chem_comp name to new entity name
+    chem_comp_entity_map = {}
 
     # Create the entity for the chem_comps that need linking
-    for saveframe in need_linking:
+    for saveframe in _chemcomps_needing_entities(entry):
         if 'PDB_code' in saveframe and saveframe['PDB_code'][0] not in pynmrstar.definitions.NULL_VALUES:
+            pdb_code: str = saveframe['PDB_code'][0].upper()
             try:
-                chemcomp_entry = pynmrstar.Entry.from_database('chemcomp_' + saveframe['PDB_code'][0].upper())
+                if chemcomp_entries is None:
+                    chemcomp_entry = pynmrstar.Entry.from_database('chemcomp_' + pdb_code)
+                elif pdb_code not in chemcomp_entries:
+                    raise IOError('The chem comp %s does not exist.' % pdb_code)
+                elif chemcomp_entries[pdb_code] is None:
+                    saveframe['Note_to_annotator'] = 'Attempted to automatically look up the chem_comp and entity' \
+                                                     ' from the PDB_code, but the lookup failed. Please look it up.'
+                    chem_comp_entity_map[saveframe.name] = create_entity_for_saveframe_and_attach(entry, saveframe,
+                                                                                                  schema)
+                    continue
+                else:
+                    # The same chem comp may be used more than once
+                    chemcomp_entry = copy.deepcopy(chemcomp_entries[pdb_code])
             except IOError:
                 saveframe['Note_to_annotator'] = 'Attempted to automatically look up the chem_comp and entity' \
                                                  ' from the PDB_code, but it isn\'t valid. Please rectify.'
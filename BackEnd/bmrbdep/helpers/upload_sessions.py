@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import IO, List, Optional, Tuple
+from uuid import uuid4
+
+from bmrbdep.exceptions import RequestError, ServerError
+
+_CHUNK_READ_SIZE = 1024 * 1024
+
+
+def _copy_into(source_fd: int, fd: int, count: int, offset: int) -> None:
+    """ Copy count bytes from the start of one file into another at the offset. copy_file_range() lets the kernel (or
+    the file server) copy the data, but it is only available on Linux, and isn't supported by every filesystem - NFS
+    included - so the data is copied through this process instead when it fails. """
+
+    copied: int = 0
+    try:
+        while copied < count:
+            written: int = os.copy_file_range(source_fd, fd, count - copied, copied, offset + copied)
+            if not written:
+                break
+            copied += written
+    except (OSError, AttributeError):
+        pass
+
+    while copied < count:
+        block: bytes = os.pread(source_fd, min(_CHUNK_READ_SIZE, count - copied), copied)
+        if not block:
+            raise ServerError('Could not copy the chunk into the upload: the chunk is shorter than expected.')
+        while block:
+            written = os.pwrite(fd, block, offset + copied)
+            block = block[written:]
+            copied += written
+
+
+class UploadSession:
+    """ A resumable upload of one file, sent in chunks which may arrive in any order, in parallel, and more than
+    once. The file is assembled in place in a staging directory: every chunk is written at its offset, and a marker
+    named after the byte range is created once the chunk was written completely (and matched its checksum). A
+    retried upload only needs to send the ranges that have no marker.
+
+    Nothing here takes the deposition lock - that only happens when the finished file is moved into the deposition.
+    """
+
+    def __init__(self, staging_root: str, deposition_id: str, upload_id: str):
+        self.path: str = os.path.join(staging_root, 'sessions', upload_id)
+        self.upload_id: str = upload_id
+        try:
+            with open(os.path.join(self.path, 'session.json'), 'r') as session_file:
+                session: dict = json.load(session_file)
+        except FileNotFoundError:
+            raise RequestError('No upload with that ID exists. It may have expired or already been finished.',
+                               status_code=404)
+        if session['deposition_id'] != deposition_id:
+            raise RequestError('No upload with that ID exists. It may have expired or already been finished.',
+                               status_code=404)
+        self.filename: str = session['filename']
+        self.size: int = session['size']
+
+    @classmethod
+    def create(cls, staging_root: str, deposition_id: str, filename: str, size: int,
+               max_size: Optional[int] = None) -> 'UploadSession':
+        """ Start a new upload of a file of the given size, which may not be larger than max_size. """
+
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            raise RequestError('Invalid file size.')
+        if max_size is not None and size > max_size:
+            raise RequestError('The file is too large. Files of up to %d bytes may be uploaded.' % max_size,
+                               status_code=413)
+        upload_id: str = str(uuid4())
+        path: str = os.path.join(staging_root, 'sessions', upload_id)
+        os.makedirs(os.path.join(path, 'chunks'))
+        with open(os.path.join(path, 'data'), 'wb') as data:
+            data.truncate(size)
+        # Written last, so that a session is only ever found complete
+        with open(os.path.join(path, 'session.json.tmp'), 'w') as session_file:
+            json.dump({'deposition_id': deposition_id, 'filename': filename, 'size': size,
+                       'created': time.time()}, session_file)
+        os.rename(os.path.join(path, 'session.json.tmp'), os.path.join(path, 'session.json'))
+        return cls(staging_root, deposition_id, upload_id)
+
+    @staticmethod
+    def remove_expired(staging_root: str, max_age: float) -> None:
+        """ Remove the upload sessions that haven't received a chunk in max_age seconds. A session that is being
+        finished is left alone, unless it was claimed more than max_age seconds ago too (so finishing it failed
+        without releasing it). """
+
+        sessions_root: str = os.path.join(staging_root, 'sessions')
+        try:
+            upload_ids: List[str] = os.listdir(sessions_root)
+        except FileNotFoundError:
+            return
+        now: float = time.time()
+        for upload_id in upload_ids:
+            path: str = os.path.join(sessions_root, upload_id)
+            try:
+                # Every chunk written updates the modification time of the data (a chunk that was received before
+                #  doesn't create a new marker)
+                last_active: float = max(os.stat(os.path.join(path, 'chunks')).st_mtime,
+                                         os.stat(os.path.join(path, 'data')).st_mtime)
+                try:
+                    # Renaming the session file to claim the session changes its ctime
+                    last_active = max(last_active, os.stat(os.path.join(path, 'session.claimed')).st_ctime)
+                except FileNotFoundError:
+                    pass
+            except FileNotFoundError:
+                # Being created, finished or removed right now
+                continue
+            if now - last_active > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(self.path, 'data')
+
+    def received_ranges(self) -> List[Tuple[int, int]]:
+        """ The byte ranges received so far, merged, as inclusive (start, end) tuples. """
+
+        ranges: List[Tuple[int, int]] = []
+        for marker in os.listdir(os.path.join(self.path, 'chunks')):
+            first, last = marker.split('-')
+            ranges.append((int(first), int(last)))
+        ranges.sort()
+
+        merged: List[Tuple[int, int]] = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @property
+    def complete(self) -> bool:
+        if self.size == 0:
+            return True
+        return self.received_ranges() == [(0, self.size - 1)]
+
+    def write_chunk(self, start: int, end: int, stream: IO[bytes], sha256: Optional[str] = None) -> None:
+        """ Write the bytes start through end (inclusive) of the file from the stream. If a SHA-256 digest (in
+        hexadecimal) is given, the chunk is only recorded as received if it matches.
+
+        The chunk is received into a file of its own, and only copied into the file once it is known to be
+        complete and correct - so a broken resend of a chunk can't overwrite the bytes that were received before. """
+
+        if start < 0 or end < start or end >= self.size:
+            raise RequestError('Invalid chunk range %d-%d for a file of %d bytes.' % (start, end, self.size),
+                               status_code=416)
+
+        chunk_path: str = os.path.join(self.path, 'chunk-%s' % uuid4().hex)
+        try:
+            digest = hashlib.sha256()
+            with open(chunk_path, 'wb') as chunk_file:
+                received: int = 0
+                while received < end + 1 - start:
+                    block: bytes = stream.read(min(_CHUNK_READ_SIZE, end + 1 - start - received))
+                    if not block:
+                        break
+                    digest.update(block)
+                    chunk_file.write(block)
+                    received += len(block)
+            if received != end + 1 - start or stream.read(1):
+                raise RequestError('The chunk does not contain the bytes %d-%d.' % (start, end))
+            if sha256 and digest.hexdigest() != sha256.lower():
+                raise RequestError('The checksum of the chunk %d-%d does not match. Please send it again.' %
+                                   (start, end))
+
+            source_fd: int = os.open(chunk_path, os.O_RDONLY)
+            fd: int = os.open(self.data_path, os.O_WRONLY)
+            try:
+                _copy_into(source_fd, fd, received, start)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+                os.close(source_fd)
+        finally:
+            try:
+                os.unlink(chunk_path)
+            except FileNotFoundError:
+                pass
+
+        open(os.path.join(self.path, 'chunks', '%d-%d' % (start, end)), 'w').close()
+
+    def claim(self) -> None:
+        """ Take the session for finishing it, so that a concurrent (retried) request to finish it fails rather
+        than finishing it twice. """
+
+        try:
+            os.rename(os.path.join(self.path, 'session.json'), os.path.join(self.path, 'session.claimed'))
+        except FileNotFoundError:
+            raise RequestError('This upload is already being finished.', status_code=409)
+
+    def release(self) -> None:
+        """ Give up a claim, so that finishing the session can be tried again - unless the file was already moved
+        into the deposition. """
+
+        if not os.path.exists(self.data_path):
+            self.discard()
+            return
+        os.rename(os.path.join(self.path, 'session.claimed'), os.path.join(self.path, 'session.json'))
+
+    def discard(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -139,7 +139,7 @@ def _deposition_contact_emails(repo) -> list:
     placeholders removed. Used to authorize a depositor against their own deposition. """
 
     try:
-        contact_loop = repo.entry.get_loops_by_category("_Contact_Person")[0]
+        contact_loop = repo.entry_read_only.get_loops_by_category("_Contact_Person")[0]
         return filter_null_values(contact_loop.get_tag('Email_address'))
     except Exception:
         return []
@@ -151,15 +151,27 @@ def deposition_unlock_status(uuid):
 
     A deposition is only unlockable while annotation has not yet begun, i.e. while the ETS status is
     still 'nd'. A None status (no BMRB ID assigned yet, or ETS mocked locally) is treated as
-    unlockable so the flow works in development. """
+    unlockable so the flow works in development.
+
+    The status may have been fetched up to a minute ago, and if ETS can't be reached, an older status is reported
+    with ets_status_outdated set. If there is no status to report at all, ets_status is null, unlockable is false
+    and ets_status_outdated is set, meaning that it is unknown whether the entry can be unlocked. The unlock itself
+    always checks the current status. """
 
     with depositions.DepositionRepo(uuid, read_only=True) as repo:
         deposited = bool(repo.metadata.get('entry_deposited'))
-        ets_status = repo.get_ets_status() if deposited else None
+        bmrbnum = repo.metadata.get('bmrbnum') if deposited else None
+
+    ets_statuses, ets_status_outdated = depositions.get_cached_ets_statuses([bmrbnum])
+    ets_status = ets_statuses.get(bmrbnum)
+    if bmrbnum in ets_status_outdated and bmrbnum not in ets_statuses:
+        unlockable = False
+    else:
         unlockable = deposited and (ets_status is None or ets_status.lower() == 'nd')
 
     return jsonify({'entry_deposited': deposited,
                     'ets_status': ets_status,
+                    'ets_status_outdated': bmrbnum in ets_status_outdated,
                     'unlockable': unlockable})
 
 
@@ -170,8 +182,8 @@ def unlock_own_deposition(uuid):
     This mirrors the administrator unlock, but is gated on the signed session e-mail being one of the
     deposition's contact persons rather than on administrator privilege. Unlocking is only permitted
     while the ETS status is still 'nd' (annotation has not yet begun). As with the admin path, only the
-    metadata is mutated (entry.str is left untouched) and the assigned BMRB ID is retained so a
-    subsequent re-deposit reuses the same number. """
+    metadata is mutated (entry.str is only touched to backfill missing saveframe `_Unique_ID` tags) and the
+    assigned BMRB ID is retained so a subsequent re-deposit reuses the same number. """
 
     active_email = session.get('active_email')
     if not active_email:
@@ -193,6 +205,7 @@ def unlock_own_deposition(uuid):
             # Flip the ETS status to 'unlk' (recording a logtable entry) before re-opening the entry.
             repo.set_ets_status('unlk', 'Deposition unlocked for editing by depositor')
             repo.metadata['entry_deposited'] = False
+            repo.backfill_unique_ids()
             repo.commit('Deposition unlocked by depositor %s' % active_email)
 
         return jsonify({'commit': repo.last_commit,
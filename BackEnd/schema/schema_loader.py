@@ -377,16 +377,19 @@ if __name__ == "__main__":
                         print("Overwriting the most recent schema to ensure it is the newest one.")
                     one_overwritten = True
 
-                # Write out the web schema
-                with open(web_schema_location, 'wb') as schema_file:
+                # Write out the web schema. The running server caches schemas and reloads them when the file
+                #  changes, so write to a temporary file and rename it into place to never expose a partial file.
+                with open(web_schema_location + '.tmp', 'wb') as schema_file:
                     j = json.dumps(schema[1])
                     schema_file.write(zlib.compress(j.encode('utf-8')))
+                os.replace(web_schema_location + '.tmp', web_schema_location)
 
                 # Write out the pynmrstar input file XML
-                with open(xml_schema_location, 'w') as schema_file:
+                with open(xml_schema_location + '.tmp', 'w') as schema_file:
                     output = io.StringIO()
                     csv.writer(output).writerows(schema[2])
                     schema_file.write(output.getvalue())
+                os.replace(xml_schema_location + '.tmp', xml_schema_location)
 
                 highest_schema = schema[0]
                 print("Set schema: %s" % schema[0])
@@ -0,0 +1,194 @@
+import os
+import re
+import sqlite3
+import unittest
+from typing import Iterable, List
+
+import psycopg2
+
+from bmrbdep import depositions
+from bmrbdep.exceptions import ServerError
+
+# Set to the psycopg2 connection string of a (test) PostgreSQL database to also run the gap search against
+#  PostgreSQL. Only a temporary table is created in it.
+_POSTGRES_DSN = os.environ.get('BMRBDEP_TEST_POSTGRES')
+
+
+class SQLiteCursor:
+    """ Runs the queries written for ETS (psycopg2 placeholders) against SQLite, which understands the SQL of the gap
+    search. The statements that only make sense against ETS itself are recorded instead. """
+
+    def __init__(self, connection: 'FakeETSConnection'):
+        self._connection = connection
+        self._cursor = connection.db.cursor()
+
+    def execute(self, query: str, arguments=None):
+        statement = query.strip()
+        if 'pg_advisory_xact_lock' in statement:
+            self._connection.advisory_locks += 1
+        elif statement.startswith('INSERT INTO entrylog'):
+            if self._connection.concurrent_inserts:
+                # Someone that doesn't take the advisory lock assigns the same ID first
+                self._connection.concurrent_inserts -= 1
+                self._connection.db.execute('INSERT INTO entrylog (bmrbnum) VALUES (?);', [arguments['bmrbnum']])
+                self._connection.db.commit()
+            try:
+                self._cursor.execute('INSERT INTO entrylog (bmrbnum) VALUES (?);', [arguments['bmrbnum']])
+            except sqlite3.IntegrityError as err:
+                raise psycopg2.IntegrityError(str(err))
+        elif statement.startswith('INSERT INTO logtable'):
+            self._cursor.execute('INSERT INTO logtable (bmrbnum) SELECT max(rowid) FROM entrylog;')
+        else:
+            self._cursor.execute(re.sub(r'%\((\w+)\)s', r':\1', query), arguments or {})
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+
+class FakeETSConnection:
+    """ Stands in for a psycopg2 connection to ETS, with only the BMRB IDs of the entry log. """
+
+    def __init__(self, assigned: Iterable[int] = ()):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('CREATE TABLE entrylog (bmrbnum INTEGER UNIQUE);')
+        self.db.execute('CREATE TABLE logtable (bmrbnum INTEGER);')
+        self.db.executemany('INSERT INTO entrylog (bmrbnum) VALUES (?);', [(_,) for _ in assigned])
+        self.db.commit()
+        self.advisory_locks: int = 0
+        self.concurrent_inserts: int = 0
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def assigned(self) -> List[int]:
+        return [_[0] for _ in self.db.execute('SELECT bmrbnum FROM entrylog ORDER BY bmrbnum;')]
+
+    def logged(self) -> int:
+        return self.db.execute('SELECT count(*) FROM logtable;').fetchone()[0]
+
+
+class GapSearchTests:
+    """ The tests of the gap search, for any database that can run it. """
+
+    def assign(self, bmrbnums: Iterable[int]) -> None:
+        raise NotImplementedError
+
+    def lowest_free(self, first_id: int, end_id: int):
+        raise NotImplementedError
+
+    def test_empty_range(self):
+        self.assertEqual(self.lowest_free(30000, 40000), 30000)
+
+    def test_gap_in_the_middle(self):
+        self.assign(list(range(30000, 30010)) + list(range(30011, 30020)))
+        self.assertEqual(self.lowest_free(30000, 40000), 30010)
+
+    def test_after_the_assigned_ids(self):
+        self.assign(range(30000, 30020))
+        self.assertEqual(self.lowest_free(30000, 40000), 30020)
+
+    def test_gap_at_the_start(self):
+        self.assign(range(30005, 30020))
+        self.assertEqual(self.lowest_free(30000, 40000), 30000)
+
+    def test_ids_outside_the_range_are_ignored(self):
+        self.assign([29999, 40000, 40001])
+        self.assertEqual(self.lowest_free(30000, 40000), 30000)
+
+    def test_full_range(self):
+        self.assign(range(30000, 30010))
+        self.assertIsNone(self.lowest_free(30000, 30010))
+
+    def test_end_of_range_is_never_assigned(self):
+        # The ranges are half-open: the free ID right after the last assigned one is the (exclusive) end
+        self.assign(range(30000, 30009))
+        self.assertIsNone(self.lowest_free(30000, 30009))
+        self.assertEqual(self.lowest_free(30000, 30010), 30009)
+
+    def test_large_entry_log(self):
+        self.assign(n for n in range(30000, 230000) if n != 229000)
+        self.assertEqual(self.lowest_free(30000, 300000), 229000)
+        self.assertEqual(self.lowest_free(229001, 300000), 230000)
+
+
+class TestGapSearch(GapSearchTests, unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeETSConnection()
+
+    def assign(self, bmrbnums: Iterable[int]) -> None:
+        self.connection.db.executemany('INSERT INTO entrylog (bmrbnum) VALUES (?);', [(_,) for _ in bmrbnums])
+
+    def lowest_free(self, first_id: int, end_id: int):
+        return depositions._lowest_free_bmrbnum(self.connection.cursor(), first_id, end_id)
+
+
+@unittest.skipUnless(_POSTGRES_DSN, 'Set BMRBDEP_TEST_POSTGRES to run the gap search against PostgreSQL.')
+class TestGapSearchPostgreSQL(GapSearchTests, unittest.TestCase):
+
+    def setUp(self):
+        self.connection = psycopg2.connect(_POSTGRES_DSN)
+        self.addCleanup(self.connection.close)
+        self.cursor = self.connection.cursor()
+        # Shadows any entrylog table of the database, and is gone with the connection
+        self.cursor.execute('CREATE TEMPORARY TABLE entrylog (bmrbnum integer UNIQUE);')
+
+    def assign(self, bmrbnums: Iterable[int]) -> None:
+        self.cursor.executemany('INSERT INTO entrylog (bmrbnum) VALUES (%s);', [(_,) for _ in bmrbnums])
+
+    def lowest_free(self, first_id: int, end_id: int):
+        return depositions._lowest_free_bmrbnum(self.cursor, first_id, end_id)
+
+
+class TestAssignBMRBNum(unittest.TestCase):
+
+    ranges = [[30000, 30010], [50000, 60000]]
+
+    def test_lowest_free_id_is_assigned(self):
+        connection = FakeETSConnection([30000, 30002])
+        params = {}
+
+        self.assertEqual(depositions._assign_bmrbnum(connection, self.ranges, params), 30001)
+        self.assertEqual(params['bmrbnum'], 30001)
+        self.assertEqual(connection.assigned(), [30000, 30001, 30002])
+        self.assertEqual(connection.logged(), 1)
+        self.assertEqual(connection.advisory_locks, 1)
+
+    def test_next_range_is_used_once_one_is_full(self):
+        connection = FakeETSConnection(range(30000, 30010))
+        self.assertEqual(depositions._assign_bmrbnum(connection, self.ranges, {}), 50000)
+
+    def test_all_ranges_full(self):
+        connection = FakeETSConnection(list(range(30000, 30010)) + list(range(50000, 60000)))
+        with self.assertRaises(ServerError):
+            depositions._assign_bmrbnum(connection, self.ranges, {})
+        self.assertEqual(connection.logged(), 0)
+
+    def test_retried_when_the_id_was_taken_concurrently(self):
+        connection = FakeETSConnection([30000])
+        connection.concurrent_inserts = 1
+
+        self.assertEqual(depositions._assign_bmrbnum(connection, self.ranges, {}), 30002)
+        self.assertEqual(connection.assigned(), [30000, 30001, 30002])
+        self.assertEqual(connection.logged(), 1)
+        # The lock is taken again for the second attempt (the first one's transaction was rolled back)
+        self.assertEqual(connection.advisory_locks, 2)
+
+    def test_gives_up_after_repeated_conflicts(self):
+        connection = FakeETSConnection()
+        connection.concurrent_inserts = depositions._BMRBNUM_ASSIGNMENT_ATTEMPTS
+
+        with self.assertRaises(ServerError):
+            depositions._assign_bmrbnum(connection, self.ranges, {})
+        self.assertEqual(connection.logged(), 0)
+        self.assertEqual(connection.advisory_locks, depositions._BMRBNUM_ASSIGNMENT_ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from bmrbdep import depositions
+from bmrbdep.exceptions import ServerError
+
+
+class FakeCursor:
+    def __init__(self, connection: 'FakeConnection'):
+        self._connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def execute(self, query, arguments=None):
+        self._connection.queries.append(query)
+        if self._connection.dropped:
+            # What psycopg2 does when the server went away while the connection was idle
+            self._connection.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+
+class FakeConnection:
+    """ Stands in for a psycopg2 connection. """
+
+    def __init__(self):
+        self.closed: int = 0
+        self.dropped: bool = False
+        self.fail_rollback: bool = False
+        self.queries: list = []
+        self.rollbacks: int = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise psycopg2.InterfaceError('connection already closed')
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class TestETSConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def connect(**_):
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+
+        patches = [mock.patch.object(depositions.psycopg2, 'connect', side_effect=connect),
+                   mock.patch.dict(depositions.configuration['ets'], {'pool_size': 2, 'connect_timeout_seconds': 0.1,
+                                                                      'health_check_seconds': 30}),
+                   mock.patch.object(depositions, '_ets_pool', None)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_connection_is_reused(self):
+        with depositions.ets_connection() as first:
+            pass
+        with depositions.ets_connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(len(self.connections), 1)
+        # What wasn't committed is rolled back before the connection is reused
+        self.assertEqual(first.rollbacks, 2)
+
+    def test_concurrent_borrowers_get_separate_connections(self):
+        with depositions.ets_connection() as first:
+            with depositions.ets_connection() as second:
+                self.assertIsNot(first, second)
+        with depositions.ets_connection():
+            pass
+        self.assertEqual(len(self.connections), 2)
+
+    def test_pool_size_is_bounded(self):
+        with depositions.ets_connection(), depositions.ets_connection():
+            with self.assertRaises(ServerError):
+                with depositions.ets_connection():
+                    pass
+        self.assertEqual(len(self.connections), 2)
+
+    def test_connection_closed_during_use_is_evicted(self):
+        with depositions.ets_connection() as broken:
+            broken.closed = 2
+        with depositions.ets_connection() as replacement:
+            pass
+        self.assertIsNot(broken, replacement)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_connection_that_cannot_roll_back_is_evicted(self):
+        with depositions.ets_connection() as broken:
+            broken.fail_rollback = True
+        self.assertEqual(broken.closed, 1)
+        with depositions.ets_connection() as replacement:
+            pass
+        self.assertIsNot(broken, replacement)
+
+    def test_eviction_frees_a_slot(self):
+        for _ in range(3):
+            with depositions.ets_connection() as broken:
+                broken.closed = 2
+        with depositions.ets_connection(), depositions.ets_connection():
+            pass
+        self.assertEqual(len(self.connections), 5)
+
+    def test_recently_used_connection_is_not_checked(self):
+        with depositions.ets_connection():
+            pass
+        with depositions.ets_connection() as conn:
+            pass
+        self.assertEqual(conn.queries, [])
+
+    def test_stale_idle_connection_is_replaced(self):
+        with depositions.ets_connection() as stale:
+            pass
+        stale.dropped = True
+        with mock.patch.object(depositions.time, 'time', return_value=time.time() + 60):
+            with depositions.ets_connection() as replacement:
+                pass
+        self.assertIsNot(stale, replacement)
+        self.assertEqual(stale.queries, ['SELECT 1;'])
+        self.assertEqual(stale.closed, 1)
+
+    def test_idle_connection_that_still_works_is_reused(self):
+        with depositions.ets_connection() as first:
+            pass
+        with mock.patch.object(depositions.time, 'time', return_value=time.time() + 60):
+            with depositions.ets_connection() as second:
+                pass
+        self.assertIs(first, second)
+        self.assertEqual(first.queries, ['SELECT 1;'])
+
+    def test_unreachable_server_is_reported(self):
+        with mock.patch.object(depositions.psycopg2, 'connect',
+                               side_effect=psycopg2.OperationalError('could not connect')):
+            with self.assertRaises(ServerError):
+                with depositions.ets_connection():
+                    pass
+        # The failed attempt doesn't use up a slot
+        with depositions.ets_connection(), depositions.ets_connection():
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import pynmrstar
+import requests
+
+from bmrbdep.helpers import pubmed
+
+_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def _fixture(name: str) -> str:
+    with open(os.path.join(_FIXTURES, name), 'r') as fixture:
+        return fixture.read()
+
+
+def _response(text: str, status_code: int = 200) -> mock.Mock:
+    return mock.Mock(status_code=status_code, text=text)
+
+
+class TestFetchPubMedRecords(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(pubmed, '_session')
+        self.session = patch.start()
+        self.addCleanup(patch.stop)
+        self.session.get.return_value = _response(_fixture('pubmed_articles.xml'))
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache = pubmed.PubMedCache(cache_dir.name, max_age=3600, not_found_max_age=60)
+
+    def requested_ids(self):
+        return [call.kwargs['params']['id'] for call in self.session.get.call_args_list]
+
+    def test_records_are_parsed(self):
+        records = pubmed.fetch_pubmed_records(['18066560', '27402221'])
+
+        self.assertEqual(self.requested_ids(), ['18066560,27402221'])
+        self.assertEqual(records['18066560']['authors'],
+                         [['Eldon', 'Ulrich', 'E.', 'L.', '.'],
+                          ['Hideo', 'Akutsu', 'H.', '.', '.'],
+                          ['John', 'Markley', 'J.', 'L.', 'Jr']])
+        self.assertEqual(records['18066560']['tags'],
+                         {'Title': 'BioMagResBank.', 'Journal_abbrev': 'J Biomol NMR',
+                          'Journal_name_full': 'Journal of biomolecular NMR', 'Journal_volume': '40',
+                          'Journal_issue': '1', 'Journal_ISSN': '1573-5001', 'DOI': '10.1093/nar/gkm957',
+                          'Year': '2008', 'Page_first': 'D402', 'Page_last': 'D408'})
+        # The abbreviated last page is completed
+        self.assertEqual(records['27402221']['tags']['Year'], '2016')
+        self.assertEqual(records['27402221']['tags']['Page_first'], '11939')
+        self.assertEqual(records['27402221']['tags']['Page_last'], '11944')
+
+    def test_ids_are_fetched_in_batches(self):
+        pubmed_ids = [str(10000000 + x) for x in range(250)]
+        self.session.get.return_value = _response(_fixture('pubmed_id_list_empty.xml'))
+
+        records = pubmed.fetch_pubmed_records(pubmed_ids + pubmed_ids[:10])
+
+        self.assertEqual(self.requested_ids(), [','.join(pubmed_ids[:pubmed._BATCH_SIZE]),
+                                                ','.join(pubmed_ids[pubmed._BATCH_SIZE:])])
+        self.assertEqual(set(records), set(pubmed_ids))
+
+    def test_cached_records_are_not_fetched_again(self):
+        first = pubmed.fetch_pubmed_records(['18066560', '27402221'], cache=self.cache)
+        second = pubmed.fetch_pubmed_records(['18066560', '27402221'], cache=self.cache)
+
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(first, second)
+
+    def test_only_uncached_ids_are_fetched(self):
+        pubmed.fetch_pubmed_records(['18066560'], cache=self.cache)
+        pubmed.fetch_pubmed_records(['18066560', '27402221'], cache=self.cache)
+
+        self.assertEqual(self.requested_ids(), ['18066560', '27402221'])
+
+    def test_unknown_ids_are_cached_briefly(self):
+        self.session.get.return_value = _response(_fixture('pubmed_id_list_empty.xml'))
+        records = pubmed.fetch_pubmed_records(['99999999'], cache=self.cache)
+        self.assertEqual(records, {'99999999': {'error': pubmed._NOT_FOUND}})
+
+        pubmed.fetch_pubmed_records(['99999999'], cache=self.cache)
+        self.assertEqual(self.session.get.call_count, 1)
+
+        # Once not_found_max_age has passed PubMed is asked again, in case the article was released since
+        with mock.patch.object(pubmed.time, 'time', return_value=time.time() + 120):
+            pubmed.fetch_pubmed_records(['99999999'], cache=self.cache)
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_ids_missing_from_the_response_are_not_found(self):
+        records = pubmed.fetch_pubmed_records(['18066560', '27402221', '99999999'], cache=self.cache)
+
+        self.assertEqual(records['99999999'], {'error': pubmed._NOT_FOUND})
+        self.assertIn('authors', records['18066560'])
+        self.assertEqual(self.cache.get('99999999'), {'error': pubmed._NOT_FOUND})
+
+        # The articles are still cached after the not found record expired
+        with mock.patch.object(pubmed.time, 'time', return_value=time.time() + 120):
+            self.assertIsNone(self.cache.get('99999999'))
+            self.assertEqual(self.cache.get('18066560'), records['18066560'])
+
+    def test_invalid_ids_are_not_fetched(self):
+        records = pubmed.fetch_pubmed_records(['PMC1234', ''])
+
+        self.assertEqual(records, {'PMC1234': {'error': pubmed._NOT_FOUND}, '': {'error': pubmed._NOT_FOUND}})
+        self.session.get.assert_not_called()
+
+    def test_api_errors_are_not_cached(self):
+        self.session.get.return_value = _response(_fixture('pubmed_api_error.xml'))
+        records = pubmed.fetch_pubmed_records(['18066560'], cache=self.cache)
+        self.assertEqual(records, {'18066560': {'error': 'API Error: Unable to obtain query #1'}})
+
+        self.session.get.return_value = _response(_fixture('pubmed_articles.xml'))
+        records = pubmed.fetch_pubmed_records(['18066560'], cache=self.cache)
+        self.assertIn('authors', records['18066560'])
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_unreachable_pubmed_is_left_out(self):
+        self.session.get.side_effect = requests.ConnectionError('no route to host')
+        self.assertEqual(pubmed.fetch_pubmed_records(['18066560'], cache=self.cache), {})
+
+        self.session.get.side_effect = None
+        self.session.get.return_value = _response('Service unavailable', status_code=503)
+        self.assertEqual(pubmed.fetch_pubmed_records(['18066560'], cache=self.cache), {})
+        self.assertIsNone(self.cache.get('18066560'))
+
+
+class TestUpdateCitation(unittest.TestCase):
+
+    def setUp(self):
+        self.citation = pynmrstar.Saveframe.from_scratch('citation_1', '_Citation')
+        self.citation.add_tag('Sf_category', 'citations')
+        self.citation.add_tag('PubMed_ID', '18066560')
+
+    def test_record_is_applied(self):
+        with mock.patch.object(pubmed, '_session') as session:
+            session.get.return_value = _response(_fixture('pubmed_articles.xml'))
+            pubmed.update_citation_with_pubmed(self.citation)
+
+        self.assertEqual(self.citation.get_tag('Title'), ['BioMagResBank.'])
+        self.assertEqual(self.citation.get_tag('DOI'), ['10.1093/nar/gkm957'])
+        self.assertEqual(self.citation.get_tag('Status'), ['published'])
+        self.assertEqual(self.citation['_Citation_author'].get_tag(['Ordinal', 'Family_name']),
+                         [[1, 'Ulrich'], [2, 'Akutsu'], [3, 'Markley']])
+
+    def test_errors_are_noted_for_the_annotators(self):
+        pubmed.update_citation_with_pubmed_record(self.citation, {'error': pubmed._NOT_FOUND})
+        self.assertEqual(self.citation.get_tag('Note_to_annotator'), [pubmed._NOT_FOUND])
+
+        pubmed.update_citation_with_pubmed_record(self.citation, None)
+        self.assertEqual(self.citation.get_tag('Note_to_annotator'), ['API Error: PubMed could not be reached'])
+        self.assertEqual(self.citation.get_tag('Title'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
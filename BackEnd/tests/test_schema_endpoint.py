@@ -0,0 +1,45 @@
+import unittest
+
+from bmrbdep import application
+from bmrbdep.common import configuration, get_serialized_schema
+
+
+class TestSendSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.client = application.test_client()
+        self.version = configuration['schema_version']
+        self.url = '/deposition/schema/%s' % self.version
+        self.schema_hash = get_serialized_schema(self.version)[0]
+
+    def test_schema_must_be_revalidated(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+        self.assertEqual(response.get_etag(), (self.schema_hash, False))
+
+    def test_unchanged_schema_is_not_sent_again(self):
+        response = self.client.get(self.url, headers={'If-None-Match': '"%s"' % self.schema_hash})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_changed_schema_is_sent(self):
+        response = self.client.get(self.url, headers={'If-None-Match': '"outdated"'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_etag(), (self.schema_hash, False))
+
+    def test_compressed_schema_has_its_own_etag(self):
+        response = self.client.get(self.url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.get_etag(), (self.schema_hash + '-gzip', False))
+
+        response = self.client.get(self.url, headers={'Accept-Encoding': 'gzip',
+                                                      'If-None-Match': '"%s-gzip"' % self.schema_hash})
+        self.assertEqual(response.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import uuid
+from unittest import mock
+
+from bmrbdep import application, depositions
+
+
+class FakeRepo:
+    """ Stands in for a deposition opened read-only. """
+
+    def __init__(self, metadata: dict):
+        self.metadata = metadata
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class TestUnlockStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.client = application.test_client()
+        self.url = '/deposition/%s/unlock-status' % uuid.uuid4()
+        patch = mock.patch.object(depositions, 'DepositionRepo',
+                                  return_value=FakeRepo({'entry_deposited': True, 'bmrbnum': 50001}))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get_status(self, statuses: dict, outdated: set) -> dict:
+        with mock.patch.object(depositions, 'get_cached_ets_statuses', return_value=(statuses, outdated)):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.json
+
+    def test_not_yet_processed(self):
+        self.assertEqual(self.get_status({50001: 'nd'}, set()),
+                         {'entry_deposited': True, 'ets_status': 'nd', 'ets_status_outdated': False,
+                          'unlockable': True})
+
+    def test_being_processed(self):
+        self.assertFalse(self.get_status({50001: 'wait'}, set())['unlockable'])
+
+    def test_outdated_status_is_reported(self):
+        self.assertEqual(self.get_status({50001: 'nd'}, {50001}),
+                         {'entry_deposited': True, 'ets_status': 'nd', 'ets_status_outdated': True,
+                          'unlockable': True})
+
+    def test_unknown_status_is_reported(self):
+        # ETS can't be reached, and no status was fetched before
+        self.assertEqual(self.get_status({}, {50001}),
+                         {'entry_deposited': True, 'ets_status': None, 'ets_status_outdated': True,
+                          'unlockable': False})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from bmrbdep.exceptions import RequestError
+from bmrbdep.helpers import upload_sessions
+from bmrbdep.helpers.upload_sessions import UploadSession
+
+_DATA = bytes(range(256)) * 40
+
+
+class TestUploadSession(unittest.TestCase):
+
+    def setUp(self):
+        staging = tempfile.TemporaryDirectory()
+        self.addCleanup(staging.cleanup)
+        self.staging_root = staging.name
+        self.session = UploadSession.create(self.staging_root, 'deposition', 'data.txt', len(_DATA))
+
+    def send(self, start: int, end: int, data: bytes = None, sha256: str = None):
+        if data is None:
+            data = _DATA[start:end + 1]
+        self.session.write_chunk(start, end, io.BytesIO(data), sha256=sha256)
+
+    def read_data(self) -> bytes:
+        with open(self.session.data_path, 'rb') as data:
+            return data.read()
+
+    def test_chunks_in_any_order(self):
+        self.send(4096, len(_DATA) - 1)
+        self.assertFalse(self.session.complete)
+        self.send(0, 4095, sha256=hashlib.sha256(_DATA[:4096]).hexdigest())
+
+        self.assertTrue(self.session.complete)
+        self.assertEqual(self.read_data(), _DATA)
+
+    def test_copied_without_copy_file_range(self):
+        # Not available (other than on Linux), or not supported by the filesystem
+        for failure in (AttributeError("module 'os' has no attribute 'copy_file_range'"),
+                        OSError(95, 'Operation not supported')):
+            with mock.patch.object(upload_sessions.os, 'copy_file_range', side_effect=failure, create=True):
+                self.send(0, 4095)
+                self.send(4096, len(_DATA) - 1)
+            self.assertEqual(self.read_data(), _DATA)
+
+    def test_bad_resend_keeps_the_received_chunk(self):
+        self.send(0, 4095)
+        with self.assertRaises(RequestError):
+            self.send(0, 4095, data=b'x' * 100)
+        with self.assertRaises(RequestError):
+            self.send(0, 4095, data=b'x' * 4096, sha256=hashlib.sha256(_DATA[:4096]).hexdigest())
+
+        self.assertEqual(self.read_data()[:4096], _DATA[:4096])
+        self.assertEqual(self.session.received_ranges(), [(0, 4095)])
+
+    def test_invalid_range(self):
+        with self.assertRaises(RequestError) as raised:
+            self.send(0, len(_DATA))
+        self.assertEqual(raised.exception.status_code, 416)
+
+    def test_invalid_size(self):
+        for size in (-1, '10', 1.5, True, None):
+            with self.assertRaises(RequestError):
+                UploadSession.create(self.staging_root, 'deposition', 'data.txt', size)
+
+    def test_too_large(self):
+        with self.assertRaises(RequestError) as raised:
+            UploadSession.create(self.staging_root, 'deposition', 'data.txt', 1001, max_size=1000)
+        self.assertEqual(raised.exception.status_code, 413)
+
+    def test_other_depositions_cannot_use_the_session(self):
+        with self.assertRaises(RequestError) as raised:
+            UploadSession(self.staging_root, 'another deposition', self.session.upload_id)
+        self.assertEqual(raised.exception.status_code, 404)
+
+    def test_expired_sessions_are_removed(self):
+        UploadSession.remove_expired(self.staging_root, 3600)
+        self.assertTrue(os.path.exists(self.session.path))
+
+        with mock.patch.object(upload_sessions.time, 'time', return_value=upload_sessions.time.time() + 7200):
+            UploadSession.remove_expired(self.staging_root, 3600)
+        self.assertFalse(os.path.exists(self.session.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
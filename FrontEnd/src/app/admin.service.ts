@@ -18,6 +18,8 @@ export interface AdminDeposition {
   // Whether a deposited entry can still be unlocked (ETS status still 'nd', i.e. annotation has
   // not begun). Mirrors the depositor-facing unlock-status gate.
   unlockable: boolean;
+  // Set when the entry tracking system could not be reached, so unlockable is based on an older status.
+  ets_status_outdated: boolean;
 }
 
 export interface UnlockResponse {
@@ -23,6 +23,7 @@ export interface ResendValidationEmailResponse {
 export interface UnlockStatusResponse {
   entry_deposited: boolean;
   ets_status: string | null;
+  ets_status_outdated: boolean;
   unlockable: boolean;
 }
 
@@ -163,7 +164,9 @@ export class DepositionLifecycleService {
   /**
    * Ask the server whether a deposited entry can still be unlocked by the depositor. An entry is
    * unlockable only while its ETS status is still 'nd' (annotation has not begun). Returns null on
-   * error so callers can fail closed (show neither the unlock option nor a misleading message).
+   * error so callers can fail closed (show neither the unlock option nor a misleading message). If ETS
+   * couldn't be reached and no earlier status is known, `ets_status` is null, `unlockable` is false and
+   * `ets_status_outdated` is true: whether the entry can be unlocked is unknown.
    */
   getUnlockStatus(entryID: string): Observable<UnlockStatusResponse | null> {
     const apiEndPoint = `${environment.serverURL}/${entryID}/unlock-status`;
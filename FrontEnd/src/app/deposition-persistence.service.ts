@@ -117,9 +117,10 @@ export class DepositionPersistenceService implements OnDestroy {
   public hydrationComplete: Promise<void>;
   private resolveHydration!: () => void;
 
-  // Deduplicated per-version schema cache. Schemas are immutable per
-  // deposition once issued by the server, so we can safely reuse a Schema
-  // instance across every open deposition on the same version.
+  // Deduplicated per-version schema cache, so that every open deposition on
+  // the same version shares a Schema instance. The server may rewrite the
+  // newest version in place; a load that downloads a changed schema replaces
+  // the cached instance.
   private schemaCache = new Map<string, Schema>();
 
   private subscription$ = new Subscription();
@@ -458,7 +459,13 @@ export class DepositionPersistenceService implements OnDestroy {
             if (!skipMessage) {
               this.messagesService.clearMessage();
             }
-            const schemaJson = jsonData.schema;
+            // The server only references the schema version; the schema itself is a separate, cacheable resource.
+            const schemaHash = jsonData.schema_hash ?? null;
+            const {schemaJson, downloaded} = await this.fetchSchemaJSON(jsonData.schema_version, schemaHash);
+            if (downloaded) {
+              this.schemaCache.delete(schemaJson.version);
+            }
+            jsonData.schema = schemaJson;
             const schema = this.resolveSchema(schemaJson.version, schemaJson);
             // entryFromJSON expects schema bundled; reuse the cached instance.
             const loadedEntry: Entry = entryFromJSON(jsonData);
@@ -490,7 +497,7 @@ export class DepositionPersistenceService implements OnDestroy {
             // exceeded) we'd rather refuse the load than leave an in-memory entry
             // that silently won't survive a refresh.
             try {
-              await this.persistEntry(state, schemaJson);
+              await this.persistEntry(state, downloaded ? schemaJson : null, schemaHash);
             } catch (err) {
               this.openDepositions.delete(entryID);
               // Best-effort cleanup: the entry blob and/or the index may have
@@ -530,6 +537,35 @@ export class DepositionPersistenceService implements OnDestroy {
     });
   }
 
+  /**
+   * Resolve the JSON for a schema version, preferring the copy already stored in IDB when it matches
+   * the hash the server sent with the deposition, and otherwise downloading it. The server rewrites the
+   * newest schema version in place, so a stored copy is never trusted without a matching hash. Schema
+   * responses must be revalidated (by ETag) on every use, so a download of an unchanged schema is still
+   * served from the HTTP cache after a 304. `downloaded` tells whether the stored copy needs replacing.
+   */
+  private async fetchSchemaJSON(version: string, hash: string | null): Promise<{schemaJson: SchemaJSON, downloaded: boolean}> {
+    if (hash !== null) {
+      const [rawSchema, storedHash] = await Promise.all([
+        this.storage.getSchema(version),
+        this.storage.getSchemaHash(version),
+      ]);
+      if (rawSchema && storedHash === hash) {
+        return {schemaJson: JSON.parse(rawSchema) as SchemaJSON, downloaded: false};
+      }
+    }
+    const schemaURL = `${environment.serverURL}/schema/${encodeURIComponent(version)}`;
+    return new Promise<{schemaJson: SchemaJSON, downloaded: boolean}>((resolve, reject) => {
+      this.http.get<SchemaJSON>(schemaURL).subscribe({
+        next: schemaJson => resolve({schemaJson, downloaded: true}),
+        error: error => {
+          this.errorHandler.handle(error);
+          reject(error);
+        }
+      });
+    });
+  }
+
   /**
    * Surface an IDB write failure on the load path to the user. Quota-exceeded gets
    * a tailored message since the user can act on it (close other depositions, free
@@ -554,11 +590,13 @@ export class DepositionPersistenceService implements OnDestroy {
   }
 
   /**
-   * Persist an entry and (if not already cached) its schema to IDB, plus
-   * refresh the openDepositions index. The index is rewritten from the
-   * in-memory Map order so user-applied reordering survives saves.
+   * Persist an entry and (if it was downloaded) its schema and the schema's
+   * hash to IDB, plus refresh the openDepositions index. The index is
+   * rewritten from the in-memory Map order so user-applied reordering
+   * survives saves.
    */
-  private async persistEntry(state: DepositionState, schemaJson: SchemaJSON | null): Promise<void> {
+  private async persistEntry(state: DepositionState, schemaJson: SchemaJSON | null,
+                             schemaHash: string | null): Promise<void> {
     const entry = state.entry;
     const entrySerialized = JSON.stringify(entry);
     const entryJson = JSON.parse(entrySerialized);
@@ -568,8 +606,8 @@ export class DepositionPersistenceService implements OnDestroy {
     const tasks: Promise<unknown>[] = [
       this.storage.setEntry(entry.entryID, JSON.stringify(entryJson)),
     ];
-    if (schemaJson && !(await this.storage.hasSchema(version))) {
-      tasks.push(this.storage.setSchema(version, JSON.stringify(schemaJson)));
+    if (schemaJson) {
+      tasks.push(this.storage.setSchema(version, JSON.stringify(schemaJson), schemaHash));
     }
     await Promise.all(tasks);
     await this.persistIndex();
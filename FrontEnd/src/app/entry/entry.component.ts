@@ -23,6 +23,8 @@ export class EntryComponent implements OnInit, OnDestroy {
   // Whether a deposited entry can still be unlocked (ETS status still 'nd'). null while unknown
   // (status not yet fetched, or the entry isn't deposited) so the template shows neither variant.
   unlockable: boolean | null = null;
+  // Set when the server couldn't reach the entry tracking system to find out whether it is unlockable.
+  unlockStatusUnknown = false;
 
   ngOnInit() {
     this.subscription$ = this.persistence.entrySubject.subscribe({
@@ -35,9 +37,13 @@ export class EntryComponent implements OnInit, OnDestroy {
 
   private refreshUnlockStatus(): void {
     this.unlockable = null;
+    this.unlockStatusUnknown = false;
     if (this.entry && this.entry.deposited) {
       this.lifecycle.getUnlockStatus(this.entry.entryID).subscribe({
-        next: status => this.unlockable = status ? status.unlockable : null
+        next: status => {
+          this.unlockStatusUnknown = !!status && status.ets_status_outdated && status.ets_status === null && !status.unlockable;
+          this.unlockable = status && !this.unlockStatusUnknown ? status.unlockable : null;
+        }
       });
     }
   }
@@ -129,6 +129,10 @@ export interface SaveframeJSON {
 export interface EntryJSON {
   entry_id: string;
   schema: SchemaJSON;
+  /* The deposition GET only sends the version; the schema is fetched from /deposition/schema/<version>. */
+  schema_version: string;
+  /* The hash of the current schema of that version, to check a locally stored copy against. */
+  schema_hash?: string;
   email_validated: boolean;
   entry_deposited: boolean;
   deposition_nickname: string;
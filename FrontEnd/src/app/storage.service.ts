@@ -6,6 +6,7 @@ const STORE = 'kv';
 
 const ENTRY_PREFIX = 'entry:';
 const SCHEMA_PREFIX = 'schema:';
+const SCHEMA_HASH_PREFIX = 'schema-hash:';
 const OPEN_DEPOSITIONS_KEY = 'openDepositions';
 
 const LEGACY_ENTRY_KEY = 'entry';
@@ -97,12 +98,26 @@ export class StorageService {
     return this.getRaw(SCHEMA_PREFIX + version);
   }
 
-  async setSchema(version: string, json: string): Promise<void> {
-    return this.setRaw(SCHEMA_PREFIX + version, json);
+  // The server rewrites the newest schema version in place, so the stored copy is checked against this hash.
+  async getSchemaHash(version: string): Promise<string | null> {
+    return this.getRaw(SCHEMA_HASH_PREFIX + version);
   }
 
-  async hasSchema(version: string): Promise<boolean> {
-    return (await this.getRaw(SCHEMA_PREFIX + version)) !== null;
+  // The schema and its hash are written together, so a stored hash always describes the stored schema.
+  async setSchema(version: string, json: string, hash: string | null): Promise<void> {
+    const db = await this.ready;
+    return new Promise((resolve, reject) => {
+      const tx = db.transaction(STORE, 'readwrite');
+      const store = tx.objectStore(STORE);
+      store.put(json, SCHEMA_PREFIX + version);
+      if (hash === null) {
+        store.delete(SCHEMA_HASH_PREFIX + version);
+      } else {
+        store.put(hash, SCHEMA_HASH_PREFIX + version);
+      }
+      tx.oncomplete = () => resolve();
+      tx.onerror = () => reject(tx.error);
+    });
   }
 
   // Per-browser open-deposition index. Triggers lazy v1→v2 migration if needed.